@@ -19,58 +19,298 @@
 # your own creations we would love to hear from you at
 # info@WorldWideWorkshop.org !
 
-import os
 import logging
 import base64
+import random
 
+from collections import OrderedDict, deque
 from datetime import date
 from gettext import gettext as _
 
 from gi.repository import GdkPixbuf
+from gi.repository import GLib
+from gi.repository import GObject
 
 from hashlib import sha1
 
+import dbus
 from dbus.service import method, signal
 from dbus.gobject_service import ExportedGObject
 
+import journalformat
+import pollsync
+import blobstore
+from imagefetcher import ImageFetcher, MAX_CHUNK_SIZE
+from peerqueue import PeerQueue
+from votelog import VoteLog
+
 SERVICE = "org.worldwideworkshop.olpc.PollBuilder"
 IFACE = SERVICE
 PATH = "/org/worldwideworkshop/olpc/PollBuilder"
 
+# Milliseconds to wait before answering Hello, at random in the range, to
+# answer the buddies joining together at once and let a single buddy send
+# HelloBack
+HELLO_DELAY = (100, 600)
+
+# My votes are sent with VoteBatch VOTE_BATCH_DELAY milliseconds after the
+# first one, or as soon as there are VOTE_BATCH_SIZE of them
+VOTE_BATCH_DELAY = 250
+VOTE_BATCH_SIZE = 64
+
+# The most votes I sent that GetVotes can send again
+VOTE_HISTORY = 1024
+
+
+class ChoiceTable(object):
+    """
+    Map choice numbers 0-4 to values, stored in a list.
+
+    Behaves like the {0: ..., 4: ...} dicts Poll used for its options,
+    tallies and images, at a fraction of their memory. Use to_dict()
+    where a real dict is needed, for D-Bus and the journal. version
+    goes up every time a value is set.
+    """
+
+    __slots__ = ('_values', 'version')
+
+    def __init__(self, values=None, default=None, size=5):
+
+        self._values = [default] * size
+        self.version = 0
+
+        if values is not None:
+            for choice, value in values.iteritems():
+                choice = int(choice)
+
+                if choice >= len(self._values):
+                    self._values.extend(
+                        [default] * (choice + 1 - len(self._values)))
+
+                self._values[choice] = value
+
+    def __getitem__(self, choice):
+
+        if not 0 <= choice < len(self._values):
+            raise KeyError(choice)
+
+        return self._values[choice]
+
+    def __setitem__(self, choice, value):
+
+        if not 0 <= choice < len(self._values):
+            raise KeyError(choice)
+
+        self._values[choice] = value
+        self.version += 1
+
+    def __contains__(self, choice):
+        return 0 <= choice < len(self._values)
+
+    def __iter__(self):
+        return iter(xrange(len(self._values)))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+
+        if isinstance(other, ChoiceTable):
+            other = other.to_dict()
+
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, choice, default=None):
+
+        if choice in self:
+            return self[choice]
+
+        return default
+
+    def fill(self, choice, value):
+        """
+        Set the value of choice without changing version, for values
+        that are only a cache, like decoded images.
+        """
+
+        if not 0 <= choice < len(self._values):
+            raise KeyError(choice)
+
+        self._values[choice] = value
+
+    def keys(self):
+        return range(len(self._values))
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(enumerate(self._values))
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return enumerate(self._values)
+
+    def to_dict(self):
+        return dict(enumerate(self._values))
+
+
+class ImageRefTable(ChoiceTable):
+    """
+    The journal objects of the option images, by choice.
+
+    Choices without an image read as an empty dict, which is only
+    created when somebody asks for it, so polls without images don't
+    carry five empty dicts around.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, values=None, size=5):
+
+        ChoiceTable.__init__(self, values, None, size)
+
+        for choice, value in enumerate(self._values):
+            if not value:
+                self._values[choice] = None
+
+    def __getitem__(self, choice):
+
+        value = ChoiceTable.__getitem__(self, choice)
+
+        if value is None:
+            # The caller may fill it in, as ItemOptionNewPoll does
+            value = self._values[choice] = {}
+
+        return value
+
+    def itervalues(self):
+
+        for choice in self:
+            yield self[choice]
+
+    def iteritems(self):
+
+        for choice in self:
+            yield choice, self[choice]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        return dict(self.iteritems())
 
-class Poll():
+    def get_id(self, choice):
+        """
+        Return the journal object id of the image, or ''.
+        """
+
+        value = self._values[choice]
+
+        if value:
+            return value.get('id', '')
+
+        return ''
+
+
+class Poll(object):
     """
     Represent the data of one poll.
     """
 
+    __slots__ = ('activity', '_sha', '_title', '_author', 'active',
+                 'createdate', 'maxvoters', 'question', 'number_of_options',
+                 'options', 'images', 'images_ds_objects', 'data', 'votes',
+                 'vote_log', 'last_vote', '_vote_count', '_version',
+                 '_dump_cache', '_images_buf', '_wire_cache',
+                 '_packed_cache', 'sync_position', 'journal_identity')
+
+    _logger = logging.getLogger('poll-activity.Poll')
+
+    # Setting these makes the poll dirty, see version
+    _TRACKED = frozenset(['active', 'createdate', 'maxvoters', 'question',
+                          'number_of_options', 'options', 'images',
+                          'images_ds_objects', 'data', 'votes', 'vote_log'])
+
     def __init__(
             self, activity=None, title='', author='', active=False,
             createdate=date.today(), maxvoters=20, question='',
             number_of_options=5, options=None, data=None, votes=None,
-            images=None, images_ds_objects=None):
+            images=None, images_ds_objects=None, vote_log=None):
 
         # Create the Poll.
+        self._version = 0
+        self._dump_cache = None
+        # choice -> (image, base64 PNG), made when the poll is sent
+        self._images_buf = None
+        self._wire_cache = None
+        self._packed_cache = None
+        # Version of the author's poll this copy has, see pollsync
+        self.sync_position = None
+        # (author, title) of the poll in the vote journal of the activity,
+        # before it was edited
+        self.journal_identity = (author, title)
         self.activity = activity
-        self.title = title
-        self.author = author
+        self._sha = None
+        self._title = title
+        self._author = author
         self.active = active
         self.createdate = createdate
         self.maxvoters = maxvoters
         self.question = question
         self.number_of_options = number_of_options
-        self.options = (options or {0: '', 1: '', 2: '', 3: '', 4: ''})
-        self.images = (images or {0: '', 1: '', 2: '', 3: '', 4: ''})
-
-        self.images_ds_objects = (images_ds_objects or {0: {}, 1: {}, 2: {},
-                                                        3: {}, 4: {}})
-
-        self.data = (data or {0: 0, 1: 0, 2: 0, 3: 0, 4: 0})
+        self.options = ChoiceTable(options, '')
+        self.images = ChoiceTable(images, '')
+        self.images_ds_objects = ImageRefTable(images_ds_objects)
+        self.data = ChoiceTable(data, 0)
         self.votes = (votes or {})
+        # Every vote cast, self.votes only keeps the last one per voter
+        if vote_log is None:
+            # The votes counted in data were cast before the log was kept
+            vote_log = VoteLog()
+            vote_log.set_baseline(self.data)
+
+        self.vote_log = vote_log
         self.last_vote = None
 
-        self._logger = logging.getLogger('poll-activity.Poll')
         self._logger.debug('Creating Poll(%s by %s)' % (title, author))
 
+        # Running total of self.data, kept up to date by register_vote
+        self._vote_count = sum(
+            int(self.data.get(choice, 0)) for choice in self.options)
+
+    def __setattr__(self, name, value):
+
+        object.__setattr__(self, name, value)
+
+        if name in self._TRACKED:
+            self._version += 1
+
+    @property
+    def version(self):
+        """
+        A number that changes every time the poll is modified.
+        """
+
+        return (self._version + self.options.version +
+                self.images.version + self.images_ds_objects.version)
+
     def dump(self):
         """
         Dump a pickled version for the journal.
@@ -87,44 +327,196 @@ class Poll():
         data['maxvoters'] = int(self.maxvoters)
         data['question'] = str(self.question)
         data['number_of_options'] = int(self.number_of_options)
-        data['options'] = self.options
-        data['data'] = self.data
-        data['votes'] = self.votes
+        data['options'] = self.options.to_dict()
+        data['data'] = self.data.to_dict()
+        data['votes'] = dict(self.votes)
+        data['vote_log'] = self.vote_log.dump()
 
         images_objects_id = {}
 
         for key in self.images_ds_objects:
-            if not self.images_ds_objects[key] == {}:
-                value = self.images_ds_objects[key]['id']
-                images_objects_id[int(key)] = str(value)
-            else:
-                images_objects_id[int(key)] = ''
+            images_objects_id[int(key)] = \
+                str(self.images_ds_objects.get_id(key))
 
         data['images_ds_objects'] = images_objects_id
         return data
 
+    def dump_binary(self):
+        """
+        Return dump() encoded as a compressed journalformat record.
+
+        The encoded poll is cached, so saving the journal only encodes
+        the polls modified since the last save.
+        """
+
+        version = self.version
+
+        if self._dump_cache is None or self._dump_cache[0] != version:
+            self._dump_cache = (
+                version, journalformat.encode_poll(self.dump(), True))
+
+        return self._dump_cache[1]
+
+    def snapshot(self):
+        """
+        Return (version, record, data) to save the poll from another
+        thread. record is the cached dump_binary(), or None and data is
+        a copy of dump() to encode.
+        """
+
+        version = self.version
+
+        if self._dump_cache is not None and self._dump_cache[0] == version:
+            return version, self._dump_cache[1], None
+
+        return version, None, self.dump()
+
+    def set_binary_cache(self, version, record):
+        """
+        Keep record, the poll at version encoded elsewhere, for
+        dump_binary.
+        """
+
+        if version == self.version:
+            self._dump_cache = (version, record)
+
     @property
     def vote_count(self):
         """
         Return the total votes cast.
         """
 
-        total = 0
+        return self._vote_count
+
+    def check_vote_count(self):
+        """
+        Recompute the running vote total from self.data.
+
+        Every option gets a counter in self.data. Return False if the
+        counters don't match the votes replayed from the vote log.
+        """
+
+        tally = self.vote_log.tally(self.number_of_options)
+        consistent = True
 
         for choice in self.options.keys():
-            total += self.data[choice]
+            self.data[choice] = int(self.data.get(choice, 0))
+
+            if self.data[choice] != tally.get(choice, 0):
+                self._logger.debug('%s has %d votes for %s, the log has %d' %
+                                   (self.title, self.data[choice], choice,
+                                    tally.get(choice, 0)))
+                consistent = False
+
+        self._vote_count = sum(self.data[choice] for choice in self.options)
+
+        return consistent
 
-        return total
+    @property
+    def title(self):
+        return self._title
+
+    @title.setter
+    def title(self, title):
+        self._title = title
+        self.__identity_changed()
+
+    @property
+    def author(self):
+        return self._author
+
+    @author.setter
+    def author(self, author):
+        self._author = author
+        self.__identity_changed()
 
     @property
     def sha(self):
         """
         Return a sha1 hash of something about this poll.
 
-        Currently we sha1 the poll title and author.
+        Currently we sha1 the poll title and author. The digest is
+        cached until one of them changes.
+        """
+
+        if self._sha is None:
+            self._sha = sha1(self._title + self._author).hexdigest()
+
+        return self._sha
+
+    def __identity_changed(self):
+        """
+        Forget the cached sha and reindex the poll if it is stored.
+        """
+
+        self._sha = None
+        self._version += 1
+
+        if self.activity is not None and self in self.activity._polls:
+            self.activity._polls.reindex(self)
+
+    def apply_update(self, fields, votes, images, position):
+        """
+        Apply the changes sent by the author of the poll. Only the
+        values that differ from mine are set, so a poll sent again
+        unchanged stays clean.
+
+        fields -- dict of the changed fields, from pollsync.read_fields
+        votes -- list of (votersha, choice) tuples
+        images -- dict of choice to pixbuf, or '' for no image
+        position -- the version of the poll after the changes
+
+        Return True if anything changed.
         """
 
-        return sha1(self.title + self.author).hexdigest()
+        changed = False
+
+        if 'title' in fields and self.title != fields['title']:
+            # Renamed by the author
+            self.title = fields['title']
+            changed = True
+
+        for name in ('active', 'createdate', 'maxvoters', 'question',
+                     'number_of_options'):
+            if name in fields and getattr(self, name) != fields[name]:
+                setattr(self, name, fields[name])
+                changed = True
+
+        for choice, text in fields.get('options', {}).iteritems():
+            if self.options.get(choice) != text:
+                self.options[choice] = text
+                changed = True
+
+        for votersha, choice in votes:
+            if self.votes.get(votersha) != choice:
+                self.votes[votersha] = choice
+                changed = True
+
+        # The author's tally already counts the votes sent by the voters
+        data_changed = False
+
+        for choice, count in fields.get('data', {}).iteritems():
+            if self.data.get(choice) != count:
+                self.data[choice] = count
+                data_changed = True
+
+        if data_changed:
+            # It also counts votes that are not in my log
+            self.vote_log.set_baseline(self.data)
+            changed = True
+
+        for choice, pixbuf in images.iteritems():
+            if self.images.get(choice) != pixbuf:
+                self.images[choice] = pixbuf
+                changed = True
+
+        if changed:
+            self._version += 1
+            self.check_vote_count()
+
+        self.sync_position = position
+
+        return changed
 
     def register_vote(self, choice, votersha):
         """
@@ -147,26 +539,14 @@ class Poll():
                 #        'old choice %d' % (votersha, self.votes[votersha]))
                 #    self.data[self.votes[votersha]] -= 1
 
-                self.votes[votersha] = choice
-                self.data[choice] += 1
-                self.last_vote = choice
-                self._logger.debug(
-                    'Recording vote %d by %s on %s by %s' %
-                    (choice, votersha, self.title, self.author))
+                self.__record_vote(choice, votersha)
 
                 # Close poll:
                 if self.vote_count >= self.maxvoters:
                     self.active = False
                     self._logger.debug('Poll hit maxvoters, closing')
 
-                if self.activity.poll_session:
-                    # We are shared so we can send the Vote signal if I voted
-                    if votersha == self.activity.nick_sha1:
-                        self._logger.debug(
-                            'Shared, I voted so sending signal')
-
-                        self.activity.poll_session.Vote(
-                            self.author, self.title, choice, votersha)
+                self.__send_vote(choice, votersha)
 
             else:
                 raise OverflowError('Poll reached maxvoters')
@@ -174,162 +554,1039 @@ class Poll():
         else:
             raise ValueError('Poll closed')
 
+    def register_votes(self, votes):
+        """
+        Register many votes on the poll in one pass.
+
+        votes -- iterable of (choice, votersha) tuples
+
+        maxvoters and the closing of the poll are checked once for the
+        whole batch. Return the list of (choice, votersha) tuples that
+        were rejected because the poll is closed or full, or because
+        the choice is not one of the options.
+        """
+
+        votes = list(votes)
+
+        if not self.active:
+            self._logger.debug('Poll closed, rejecting %d votes' %
+                               len(votes))
+            return votes
+
+        room = self.maxvoters - self._vote_count
+        accepted = []
+        rejected = []
+
+        for choice, votersha in votes:
+            if len(accepted) < room and \
+                    0 <= choice < self.number_of_options:
+                accepted.append((choice, votersha))
+
+            else:
+                rejected.append((choice, votersha))
+
+        for choice, votersha in accepted:
+            self.__record_vote(choice, votersha)
+
+        self._logger.debug('Recorded %d votes on %s by %s, rejected %d' %
+                           (len(accepted), self.title, self.author,
+                            len(rejected)))
+
+        # Close poll:
+        if self.vote_count >= self.maxvoters:
+            self.active = False
+            self._logger.debug('Poll hit maxvoters, closing')
+
+        for choice, votersha in accepted:
+            self.__send_vote(choice, votersha)
+
+        return rejected
+
+    def __record_vote(self, choice, votersha):
+
+        self.votes[votersha] = choice
+        self.vote_log.append(choice, votersha)
+        self.data[choice] += 1
+        self._vote_count += 1
+        self._version += 1
+        self.last_vote = choice
+        self._logger.debug(
+            'Recording vote %d by %s on %s by %s' %
+            (choice, votersha, self.title, self.author))
+
+    def __send_vote(self, choice, votersha):
+
+        if self.activity.poll_session:
+            # We are shared so we can send the Vote signal if I voted
+            if votersha == self.activity.nick_sha1:
+                self._logger.debug(
+                    'Shared, I voted so sending signal')
+
+                self.activity.poll_session.send_vote(
+                    self.author, self.title, choice, votersha)
+
+    def image_pending(self, choice):
+        """
+        Return True if the image of choice was not decoded yet.
+        """
+
+        return self.images[choice] is None
+
+    def get_image_file_path(self, choice):
+        """
+        Return the path of the journal file with the image of choice,
+        or '' if the choice has no image.
+
+        The path is not kept here, the file belongs to the journal
+        object in the activity datastore cache.
+        """
+
+        image_ds_object = self.images_ds_objects[choice]
+
+        if not image_ds_object.get('id'):
+            return ''
+
+        return self.activity.get_ds_object_file_path(image_ds_object['id'])
+
+    def get_image_thumbnail_path(self, choice, width, height):
+        """
+        Return the path of the thumbnail of the image of choice in the
+        activity thumbnail cache, or None.
+        """
+
+        ds_object_id = self.images_ds_objects.get_id(choice)
+
+        if not ds_object_id:
+            return None
+
+        return self.activity.get_thumbnail_path(ds_object_id, width, height)
+
+    def __get_image_size(self):
+
+        # The images were always decoded at height x width
+        return (self.activity._image_size['height'],
+                self.activity._image_size['width'])
+
+    def load_image(self, choice):
+        """
+        Decode the image of choice if it was not decoded yet.
+
+        Polls read from the journal only know the journal objects of
+        their images, these are decoded the first time they are needed.
+        """
+
+        if not self.image_pending(choice):
+            return
+
+        width, height = self.__get_image_size()
+        thumbnail_path = self.get_image_thumbnail_path(choice, width, height)
+        pixbuf = None
+
+        if thumbnail_path is not None:
+            pixbuf = self.activity.thumbnail_cache.load(thumbnail_path)
+
+        if pixbuf is None:
+            image_file_path = self.get_image_file_path(choice)
+            pixbuf = ''
+
+            if image_file_path:
+                try:
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                        image_file_path, width, height)
+
+                except GLib.GError, e:
+                    self._logger.debug('Can not load image %s: %s' %
+                                       (image_file_path, e))
+
+                else:
+                    if thumbnail_path is not None:
+                        self.activity.thumbnail_cache.store(thumbnail_path,
+                                                            pixbuf)
+
+        # Decoding does not change the poll, see version
+        self.images.fill(choice, pixbuf)
+
+    def request_image(self, choice, callback, *args):
+        """
+        Decode the image of choice on the activity's ImageDecoder.
+
+        callback(pixbuf, *args) is called from the main loop once the
+        image is decoded, pixbuf is '' if the choice has no image.
+        Return the DecodeRequest, or None if the image was already decoded
+        and callback was called right away.
+        """
+
+        if self.image_pending(choice):
+            image_file_path = self.get_image_file_path(choice)
+
+            if image_file_path:
+                width, height = self.__get_image_size()
+
+                return self.activity.image_decoder.decode_thumbnail(
+                    self.get_image_thumbnail_path(choice, width, height),
+                    image_file_path, width, height,
+                    self.__image_decoded_cb, choice,
+                    self.images_ds_objects.get_id(choice), callback, args)
+
+            self.images.fill(choice, '')
+
+        callback(self.images[choice], *args)
+
+        return None
+
+    def __image_decoded_cb(self, pixbuf, choice, object_id, callback,
+                           args):
+
+        if self.image_pending(choice):
+            if self.images_ds_objects.get_id(choice) != object_id:
+                # The image was replaced while it was decoded
+                self.request_image(choice, callback, *args)
+                return
+
+            self.images.fill(choice, pixbuf or '')
+
+        callback(self.images[choice], *args)
+
+    def get_image(self, choice):
+        """
+        Return the pixbuf of choice, decoding it if needed, or ''.
+        """
+
+        self.load_image(choice)
+
+        return self.images[choice]
+
+    def get_images_buf(self):
+        """
+        Return the images encoded to be sent over the tube.
+
+        Every image is encoded once, until it changes.
+        """
+
+        if self._images_buf is None:
+            self._images_buf = {}
+
+        images_buf = {}
+        width, height = self.__get_image_size()
+
+        for img_number in self.images:
+            ds_object_id = self.images_ds_objects.get_id(img_number)
+
+            if ds_object_id:
+                image = (ds_object_id, width, height)
+
+            else:
+                image = self.images[img_number]
+
+            cached = self._images_buf.get(img_number)
+
+            if cached is None or cached[0] != image:
+                cached = self._images_buf[img_number] = \
+                    (image, self.__encode_image(img_number, width, height))
+
+            images_buf[img_number] = cached[1]
+
+        return images_buf
+
+    def set_images_buf(self, images_buf):
+        """
+        Keep the encoded images the poll was received with, so they are
+        not encoded again to be sent, and a poll sent again with the
+        same images is not decoded again, see has_image_buf.
+        """
+
+        if self._images_buf is None:
+            self._images_buf = {}
+
+        for choice, image_buf in images_buf.iteritems():
+            if choice in self.images and \
+                    not self.images_ds_objects.get_id(choice):
+                self._images_buf[choice] = (self.images[choice], image_buf)
+
+    def has_image_buf(self, choice, image_buf):
+        """
+        Return True if image_buf is the encoded image of choice.
+        """
+
+        if image_buf == '':
+            return self.images.get(choice) == ''
+
+        cached = (self._images_buf or {}).get(choice)
+
+        return cached is not None and cached[1] == image_buf and \
+            cached[0] is self.images.get(choice)
+
+    def __encode_image(self, choice, width, height):
+
+        thumbnail_path = self.get_image_thumbnail_path(choice, width, height)
+
+        if thumbnail_path is not None:
+            # Already encoded in the thumbnail cache
+            png = self.activity.thumbnail_cache.read(thumbnail_path)
+
+            if png is not None:
+                return base64.b64encode(png)
+
+        pixbuf = self.get_image(choice)
+
+        if pixbuf == '':
+            return ''
+
+        return self.get_buffer(pixbuf)
+
     def get_buffer(self, pixbuf):
+        """
+        Return pixbuf as base64 encoded PNG data.
+        """
+
+        success, png = pixbuf.save_to_bufferv('png', [], [])
+
+        return base64.b64encode(png)
+
+    def get_wire_snapshot(self):
+        """
+        Return the arguments of UpdatePoll and UpdatedPoll for the poll.
+
+        They are built again only when the poll or the image size
+        changed, and the same tuple is sent to every buddy.
+        """
+
+        image_size = self.__get_image_size()
+
+        if self._wire_cache is not None and \
+                self._wire_cache[0] == (self.version, image_size):
+            return self._wire_cache[1]
+
+        images_buf = self.get_images_buf()
+
+        snapshot = (
+            self.title, self.author, int(self.active),
+            self.createdate.toordinal(), self.maxvoters, self.question,
+            self.number_of_options,
+            dbus.Dictionary(self.options.to_dict(), signature='us'),
+            dbus.Dictionary(self.data.to_dict(), signature='uu'),
+            dbus.Dictionary(self.votes, signature='su'),
+            dbus.Dictionary(images_buf, signature='us'))
+
+        self._wire_cache = ((self.version, image_size), snapshot)
+
+        return snapshot
+
+    def get_packed(self):
+        """
+        Return pollsync.pack_poll() of the poll, cached until the poll
+        changes.
+        """
+
+        version = self.version
+
+        if self._packed_cache is None or self._packed_cache[0] != version:
+            self._packed_cache = (version, pollsync.pack_poll(self))
+
+        return self._packed_cache[1]
+
+    def broadcast_on_mesh(self):
+
+        if self.activity.poll_session:
+            # We are shared so we can broadcast this poll
+            self.activity.poll_session.broadcast_poll(self)
+
+
+class PollStore(object):
+    """
+    The polls known by the activity.
+
+    Iterates like the set it replaces, in the order polls were added,
+    and keeps indexes by sha, by (author, title) and by author so the
+    lookups done for every mesh vote don't scan every poll.
+    """
+
+    def __init__(self, polls=()):
+
+        self._keys = OrderedDict()  # poll -> (sha, (author, title))
+        self._by_sha = {}
+        self._by_title = {}
+        self._by_author = {}
+
+        for poll in polls:
+            self.add(poll)
+
+    def __iter__(self):
+        return iter(self._keys.keys())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, poll):
+        return poll in self._keys
+
+    def add(self, poll):
+        """
+        Add a poll, or reindex it if it is already in the store.
+        """
+
+        if poll in self._keys:
+            self.reindex(poll)
+            return
+
+        sha, identity = poll.sha, (poll.author, poll.title)
+        self._keys[poll] = (sha, identity)
+        self._by_sha.setdefault(sha, []).append(poll)
+        self._by_title.setdefault(identity, []).append(poll)
+        self._by_author.setdefault(identity[0], []).append(poll)
+
+    def remove(self, poll):
+        """
+        Remove a poll. Raise KeyError if it is not in the store.
+        """
+
+        sha, identity = self._keys.pop(poll)
+        self.__unindex(self._by_sha, sha, poll)
+        self.__unindex(self._by_title, identity, poll)
+        self.__unindex(self._by_author, identity[0], poll)
+
+    def discard(self, poll):
+        if poll in self._keys:
+            self.remove(poll)
+
+    def reindex(self, poll):
+        """
+        Update the indexes after the title or author of poll changed.
+        """
+
+        if self._keys.get(poll) == (poll.sha, (poll.author, poll.title)):
+            return
+
+        # Remove and add again, keeping the position in the iteration
+        position = self._keys.keys().index(poll)
+        self.remove(poll)
+        self.add(poll)
+
+        for other in self._keys.keys()[position:-1]:
+            self._keys[other] = self._keys.pop(other)
+
+    def get(self, sha):
+        """
+        Return the poll with this sha, or None.
+        """
+
+        polls = self._by_sha.get(sha)
+
+        if polls:
+            return polls[0]
+
+        return None
+
+    def find(self, author, title):
+        """
+        Return the list of polls with this author and title.
+        """
+
+        return list(self._by_title.get((author, title), ()))
+
+    def by_author(self, author):
+        """
+        Return the list of polls created by author.
+        """
+
+        return list(self._by_author.get(author, ()))
+
+    def __unindex(self, index, key, poll):
+
+        polls = index[key]
+        polls.remove(poll)
+
+        if not polls:
+            del index[key]
+
+
+class PollSession(ExportedGObject):
+    """
+    The bit that talks over the TUBES!!!
+    """
+
+    def __init__(self, tube, is_initiator, get_buddy, activity):
+        """
+        Initialise the PollSession.
+
+        tube -- TubeConnection
+        is_initiator -- boolean, True = we are sharing, False = we are joining
+        get_buddy -- function
+        activity -- PollBuilder (sugar3.activity.Activity)
+        """
+
+        super(PollSession, self).__init__(tube, PATH)
+        self._logger = logging.getLogger('poll-activity.PollSession')
+        self.tube = tube
+        self.is_initiator = is_initiator
+        self.entered = False  # Have we set up the tube?
+        self._get_buddy = get_buddy  # Converts handle to Buddy object
+        self.activity = activity  # PollBuilder
+        # Mesh votes waiting to be applied, by (author, title)
+        self._pending_votes = OrderedDict()
+        self._pending_votes_id = None
+        # Bus names by handle, and the ones that know about deltas
+        self._participants = {}
+        self._delta_peers = set()
+        self._image_ref_peers = set()
+        self._vote_batch_peers = set()
+        self._packed_peers = set()
+        # The images sent and received, and the ones being fetched
+        self.blobs = blobstore.BlobStore(get_live=self.__live_images)
+        self._image_waiters = {}  # sha1 -> list of (poll, choice)
+        self._image_fetcher = ImageFetcher(
+            self.blobs, lambda bus_name: self.tube.get_object(bus_name, PATH),
+            IFACE)
+        # What every delta peer was sent: (bus name, poll) -> state
+        self._sent = {}
+        # The calls to the other participants, a few at a time
+        self._calls = PeerQueue(
+            lambda bus_name: self.tube.get_object(bus_name, PATH))
+        # The buddies whose Hello I will answer, and the ones somebody
+        # sent HelloBack to
+        self._newcomers = set()
+        self._newcomers_id = None
+        self._answered = set()
+        # Somebody answered my Hello, the buddies that know about deltas
+        # are sent my polls as soon as I know it
+        self._hello_answered = False
+        # My votes waiting for VoteBatch, and the ones sent, by sequence
+        # number
+        self._vote_batch = []
+        self._vote_batch_id = None
+        self._vote_seq = 0
+        self._vote_history = deque(maxlen=VOTE_HISTORY)
+        # The sequence number of the next vote of every buddy
+        self._vote_seqs = {}
+        # The votes received with Vote from every buddy before I knew it
+        # sends VoteBatch, in order, that its next batches repeat
+        self._unbatched_votes = {}
+        self.tube.watch_participants(self.__participant_change_cb)
+
+    def __participant_change_cb(self, added, removed):
+        """
+        Callback when tube participants change.
+        """
+
+        self._logger.debug('In participant_change_cb')
+
+        if added:
+            self._logger.debug('Adding participants: %r' % added)
+
+        if removed:
+            self._logger.debug('Removing participants: %r' % removed)
+
+        for handle, bus_name in added:
+            self._participants[handle] = bus_name
+            buddy = self._get_buddy(handle)
+
+            if buddy is not None:
+                self._logger.debug('Buddy %s was added' % buddy.props.nick)
+
+        for handle in removed:
+            self.__forget_peer(self._participants.pop(handle, None))
+            buddy = self._get_buddy(handle)
+
+            if buddy is not None:
+                self._logger.debug('Buddy %s was removed' % buddy.props.nick)
+                # Set buddy's polls to not active so I can't vote on them
+
+                for poll in self.activity._polls.by_author(
+                        buddy.props.nick):
+                    poll.active = False
+
+                    self._logger.debug(
+                        'Closing poll %s of %s who just left.' %
+                        (poll.title, poll.author))
+
+        if not self.entered:
+            if self.is_initiator:
+                self._logger.debug("I'm initiating the tube")
+
+            else:
+                self._logger.debug('Joining, sending Hello')
+                # Before Hello, so the replies can be deltas
+                self.Features(pollsync.FEATURES)
+                self.Hello()
+
+            self.tube.add_signal_receiver(
+                self.__hello_cb, 'Hello', IFACE,
+                path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__vote_cb, 'Vote', IFACE,
+                path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__helloback_cb, 'HelloBack',
+                IFACE, path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__updatedpoll_cb, 'UpdatedPoll',
+                IFACE, path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__features_cb, 'Features',
+                IFACE, path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__polldelta_cb, 'PollDelta',
+                IFACE, path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__vote_batch_cb, 'VoteBatch',
+                IFACE, path=PATH,
+                sender_keyword='sender')
+
+            self.tube.add_signal_receiver(
+                self.__pollpacked_cb, 'PollPacked',
+                IFACE, path=PATH,
+                sender_keyword='sender', byte_arrays=True)
+
+            self.my_bus_name = self.tube.get_unique_name()
+
+            self.entered = True
+
+    @signal(dbus_interface=IFACE, signature='')
+    def Hello(self):
+        """
+        Request that my UpdatePoll method is called to let me know about
+        other known polls.
+        """
+
+    @signal(dbus_interface=IFACE, signature='ssus')
+    def Vote(self, author, title, choice, votersha):
+        """
+        Send my vote on author's poll.
+
+        author -- string, buddy name
+        title -- string, poll title
+        choice -- integer 0-4, selected vote
+        votersha -- string, sha1 of voter's nick
+        """
+
+    @signal(dbus_interface=IFACE, signature='s')
+    def HelloBack(self, recipient):
+        """
+        Respond to Hello.
+
+        recipient -- string, sender of Hello.
+        """
+
+    @signal(dbus_interface=IFACE, signature='ssuuusua{us}a{uu}a{su}a{us}')
+    def UpdatedPoll(self, title, author, active, createdate, maxvoters,
+                    question, number_of_options, options, data, votes,
+                    images_buf):
+        """
+        Broadcast a new poll to the mesh.
+        """
+
+    @signal(dbus_interface=IFACE, signature='as')
+    def Features(self, features):
+        """
+        Tell the others which protocol features I know about.
+
+        features -- list of strings, like pollsync.FEATURE_DELTA
+        """
+
+    @signal(dbus_interface=IFACE, signature='ssuua{sv}a(su)a{us}')
+    def PollDelta(self, author, title, base, position, fields, votes,
+                  images_buf):
+        """
+        Broadcast the changes of my poll since version base.
+
+        position -- integer, the version after the changes
+        fields -- dict of the changed fields, see pollsync.FIELDS
+        votes -- list of (votersha, choice) logged since base
+        images_buf -- dict of the changed images
+        """
+
+    @signal(dbus_interface=IFACE, signature='uaya{us}')
+    def PollPacked(self, position, record, images_buf):
+        """
+        Broadcast a whole poll of mine as a compressed record, in place
+        of PollDelta with base FULL when every recipient knows about
+        pollsync.FEATURE_PACKED.
+
+        position -- integer, the version of the poll
+        record -- bytes, from pollsync.pack_poll
+        images_buf -- dict of the images
+        """
+
+    @signal(dbus_interface=IFACE, signature='ua(sssu)')
+    def VoteBatch(self, first, votes):
+        """
+        Send my votes since the last batch.
+
+        first -- integer, the sequence number of the first vote, the
+          others follow
+        votes -- list of (author, title, votersha, choice)
+        """
+
+    def send_vote(self, author, title, choice, votersha):
+        """
+        Send my vote on author's poll, with Vote to the buddies that
+        don't know about VoteBatch and in the next VoteBatch to the
+        others.
+
+        Every vote goes in a VoteBatch, even when I know no buddy that
+        reads it: the ones that got my Features ignore my Vote signals.
+        """
+
+        legacy = [bus_name for bus_name in self._participants.values()
+                  if bus_name != self.my_bus_name and
+                  bus_name not in self._vote_batch_peers]
+
+        if legacy:
+            self.Vote(author, title, choice, votersha)
+
+        self._vote_batch.append((author, title, votersha, choice))
+
+        if len(self._vote_batch) >= VOTE_BATCH_SIZE:
+            self.__flush_votes()
+
+        elif self._vote_batch_id is None:
+            self._vote_batch_id = GLib.timeout_add(VOTE_BATCH_DELAY,
+                                                   self.__flush_votes)
+
+    def __flush_votes(self):
+
+        if self._vote_batch_id is not None:
+            GLib.source_remove(self._vote_batch_id)
+            self._vote_batch_id = None
+
+        votes = self._vote_batch
+        self._vote_batch = []
+
+        if votes:
+            self._logger.debug('Sending %d votes from %d' %
+                               (len(votes), self._vote_seq))
+            self.VoteBatch(self._vote_seq, votes)
+            self._vote_history.extend(votes)
+            self._vote_seq += len(votes)
+
+        return False
+
+    def broadcast_poll(self, poll):
+        """
+        Send a new or changed poll of mine to everybody.
+        """
+
+        known = [bus_name for bus_name in self._delta_peers
+                 if (bus_name, poll) in self._sent]
+        unknown = [bus_name for bus_name in self._delta_peers
+                   if (bus_name, poll) not in self._sent]
+
+        # The buddies know the poll by the title they were last sent
+        by_title = OrderedDict()
+        for bus_name in known:
+            by_title.setdefault(
+                pollsync.get_title(self._sent[(bus_name, poll)]),
+                []).append(bus_name)
+
+        for title, bus_names in by_title.iteritems():
+            update, state = pollsync.make_update(
+                poll, [self._sent[(bus_name, poll)]
+                       for bus_name in bus_names])
+
+            if all(bus_name in self._image_ref_peers
+                   for bus_name in bus_names):
+                update = self.__use_image_refs(update)
+
+            self.PollDelta(poll.author, title, *pollsync.to_dbus(update))
+
+            for bus_name in bus_names:
+                self._sent[(bus_name, poll)] = state
+
+        for bus_name in unknown:
+            self.__sync_poll(bus_name, poll)
+
+        legacy = [bus_name for bus_name in self._participants.values()
+                  if bus_name != self.my_bus_name and
+                  bus_name not in self._delta_peers]
+
+        if legacy:
+            self.UpdatedPoll(*poll.get_wire_snapshot())
+
+    def __send_polls(self, bus_names):
+        """
+        Send all my polls to bus_names that were never sent them. The
+        ones that know about deltas are sent every poll with a single
+        PollDelta signal when there are several.
+        """
+
+        delta = [bus_name for bus_name in bus_names
+                 if bus_name in self._delta_peers]
+        legacy = [bus_name for bus_name in bus_names
+                  if bus_name not in self._delta_peers]
+
+        for poll in self.activity.get_my_polls():
+            self._logger.debug('Telling %r about my %s' %
+                               (bus_names, poll.title))
+
+            for bus_name in legacy:
+                self._calls.call(bus_name, 'UpdatePoll',
+                                 *poll.get_wire_snapshot(),
+                                 dbus_interface=IFACE)
+
+            unsent = [bus_name for bus_name in delta
+                      if (bus_name, poll) not in self._sent]
+
+            if len(unsent) > 1:
+                self.__broadcast_full_poll(unsent, poll)
+
+            elif unsent:
+                self.__sync_poll(unsent[0], poll)
+
+    def __broadcast_full_poll(self, bus_names, poll):
+        """
+        Send the whole poll to bus_names, with the PollDelta signal.
+        """
+
+        update, state = pollsync.make_update(poll, [None])
+
+        if all(bus_name in self._image_ref_peers for bus_name in bus_names):
+            update = self.__use_image_refs(update)
+
+        if all(bus_name in self._packed_peers for bus_name in bus_names):
+            self.PollPacked(update[1], dbus.ByteArray(poll.get_packed()),
+                            dbus.Dictionary(update[4], signature='us'))
+
+        else:
+            self.PollDelta(poll.author, poll.title,
+                           *pollsync.to_dbus(update))
+
+        for bus_name in bus_names:
+            self._sent[(bus_name, poll)] = state
+
+    def __sync_poll(self, bus_name, poll, full=False):
+        """
+        Send poll to bus_name with SyncPoll, only the changes since it
+        was last sent unless full.
+        """
+
+        sent = self._sent.get((bus_name, poll))
+        state = None
+        if not full:
+            state = sent
+
+        # The buddy knows the poll by the title it was last sent, and
+        # replaces its copy with the whole poll sent with that title
+        title = poll.title
+        if sent is not None:
+            title = pollsync.get_title(sent)
+
+        update, self._sent[(bus_name, poll)] = pollsync.make_update(
+            poll, [state])
+
+        if bus_name in self._image_ref_peers:
+            update = self.__use_image_refs(update)
+
+        if update[0] == pollsync.FULL and bus_name in self._packed_peers \
+                and title == poll.title:
+            self._calls.call(bus_name, 'SyncPollPacked', update[1],
+                             dbus.ByteArray(poll.get_packed()),
+                             dbus.Dictionary(update[4], signature='us'),
+                             dbus_interface=IFACE)
+
+        else:
+            self._calls.call(bus_name, 'SyncPoll', poll.author, title,
+                             *pollsync.to_dbus(update),
+                             dbus_interface=IFACE)
+
+    def __use_image_refs(self, update):
+        """
+        Replace the images of an update with references to the blobs,
+        the buddies call GetImage for the ones they don't have.
+        """
+
+        base, position, fields, votes, images_buf = update
+        refs = {}
+
+        for choice, image_buf in images_buf.iteritems():
+            if image_buf == '':
+                refs[choice] = ''
+
+            else:
+                refs[choice] = blobstore.make_ref(
+                    self.blobs.add_base64(image_buf))
+
+        return base, position, fields, votes, refs
+
+    def __forget_peer(self, bus_name):
+
+        if bus_name is None:
+            return
+
+        self._calls.forget(bus_name)
+        self._newcomers.discard(bus_name)
+        self._answered.discard(bus_name)
+        self._vote_seqs.pop(bus_name, None)
+        self._unbatched_votes.pop(bus_name, None)
+        self._delta_peers.discard(bus_name)
+        self._image_ref_peers.discard(bus_name)
+        self._vote_batch_peers.discard(bus_name)
+        self._packed_peers.discard(bus_name)
+
+        for key in [key for key in self._sent if key[0] == bus_name]:
+            del self._sent[key]
+
+    def __add_features(self, bus_name, features):
+
+        if pollsync.FEATURE_DELTA in features:
+            self._logger.debug('%s knows about deltas' % bus_name)
+            self._delta_peers.add(bus_name)
+
+        if pollsync.FEATURE_IMAGE_REFS in features:
+            self._image_ref_peers.add(bus_name)
+
+        if pollsync.FEATURE_VOTE_BATCH in features:
+            self._vote_batch_peers.add(bus_name)
 
-        path = "/dev/shm/pix.png"
-        pixbuf.savev(path, "png", [], [])
+        if pollsync.FEATURE_PACKED in features:
+            self._packed_peers.add(bus_name)
 
-        pixbuf_file = open(path, 'rb')
-        image_string = base64.b64encode(pixbuf_file.read())
-        pixbuf_file.close()
+    def __features_cb(self, features, sender=None):
 
-        os.remove(path)
+        if sender == self.my_bus_name:
+            return
 
-        return image_string
+        self.__add_features(sender, features)
 
-    def broadcast_on_mesh(self):
+        # Tell the newcomer I know about deltas too
+        self._calls.call(sender, 'SetFeatures', pollsync.FEATURES,
+                         dbus_interface=IFACE)
 
-        if self.activity.poll_session:
-            images_buf = {}
+    def __polldelta_cb(self, author, title, base, position, fields, votes,
+                       images_buf, sender=None):
 
-            for img_number, img_pixbuf in self.images.iteritems():
-                if not img_pixbuf == '':
-                    images_buf[img_number] = self.get_buffer(img_pixbuf)
+        if sender == self.my_bus_name:
+            return
 
-                else:
-                    images_buf[img_number] = img_pixbuf
+        polls = self.activity._polls.find(str(author), str(title))
 
-            # We are shared so we can broadcast this poll
-            self.activity.poll_session.UpdatedPoll(
-                self.title, self.author, self.active,
-                self.createdate.toordinal(),
-                self.maxvoters, self.question, self.number_of_options,
-                self.options, self.data, self.votes, images_buf)
+        if base == pollsync.FULL:
+            if polls and polls[0].sync_position is not None:
+                # Sent to newcomers, I get the changes of my copy
+                return
 
+        elif not polls or polls[0].sync_position is None:
+            # The author sends me the whole poll with SyncPoll
+            return
 
-class PollSession(ExportedGObject):
-    """
-    The bit that talks over the TUBES!!!
-    """
+        self.__apply_update(author, title, base, position, fields, votes,
+                            images_buf, sender)
 
-    def __init__(self, tube, is_initiator, get_buddy, activity):
-        """
-        Initialise the PollSession.
+    def __pollpacked_cb(self, position, record, images_buf, sender=None):
 
-        tube -- TubeConnection
-        is_initiator -- boolean, True = we are sharing, False = we are joining
-        get_buddy -- function
-        activity -- PollBuilder (sugar3.activity.Activity)
-        """
+        if sender == self.my_bus_name:
+            return
 
-        super(PollSession, self).__init__(tube, PATH)
-        self._logger = logging.getLogger('poll-activity.PollSession')
-        self.tube = tube
-        self.is_initiator = is_initiator
-        self.entered = False  # Have we set up the tube?
-        self._get_buddy = get_buddy  # Converts handle to Buddy object
-        self.activity = activity  # PollBuilder
-        self.tube.watch_participants(self.__participant_change_cb)
+        self.__apply_packed(position, record, images_buf, sender, True)
 
-    def __participant_change_cb(self, added, removed):
+    def __apply_packed(self, position, record, images_buf, sender,
+                       broadcast):
         """
-        Callback when tube participants change.
+        Apply a whole poll from PollPacked or SyncPollPacked. The ones
+        broadcast to newcomers are ignored if I have the poll already.
         """
 
-        self._logger.debug('In participant_change_cb')
-
-        if added:
-            self._logger.debug('Adding participants: %r' % added)
-
-        if removed:
-            self._logger.debug('Removing participants: %r' % removed)
+        try:
+            author, title, fields, votes = pollsync.unpack_poll(str(record))
 
-        for handle, bus_name in added:
-            buddy = self._get_buddy(handle)
+        except ValueError, e:
+            self._logger.error('Poll from %s ignored: %s' % (sender, e))
+            return
 
-            if buddy is not None:
-                self._logger.debug('Buddy %s was added' % buddy.props.nick)
+        if broadcast:
+            polls = self.activity._polls.find(author, title)
 
-        for handle in removed:
-            buddy = self._get_buddy(handle)
+            if polls and polls[0].sync_position is not None:
+                # Sent to newcomers, I get the changes of my copy
+                return
 
-            if buddy is not None:
-                self._logger.debug('Buddy %s was removed' % buddy.props.nick)
-                # Set buddy's polls to not active so I can't vote on them
+        self.__apply_update(author, title, pollsync.FULL, position, fields,
+                            votes, images_buf, sender)
 
-                for poll in self.activity._polls:
-                    if poll.author == buddy.props.nick:
-                        poll.active = False
+    def __apply_update(self, author, title, base, position, fields, votes,
+                       images_buf, sender):
+        """
+        Apply an update from PollDelta or SyncPoll, or ask the author for
+        the whole poll if it does not apply to my copy.
+        """
 
-                        self._logger.debug(
-                            'Closing poll %s of %s who just left.' %
-                            (poll.title, poll.author))
+        author = str(author)
+        title = str(title)
+        position = int(position)
+        fields = pollsync.read_fields(fields)
+        votes = [(str(votersha), int(choice)) for votersha, choice in votes]
 
-        if not self.entered:
-            if self.is_initiator:
-                self._logger.debug("I'm initiating the tube")
+        images = {}
+        missing = []
 
-            else:
-                self._logger.debug('Joining, sending Hello')
-                self.Hello()
+        for key in images_buf:
+            image_buf = str(images_buf[key])
+            blob_hash = blobstore.get_ref_hash(image_buf)
 
-            self.tube.add_signal_receiver(
-                self.__hello_cb, 'Hello', IFACE,
-                path=PATH,
-                sender_keyword='sender')
+            if image_buf == '':
+                images[int(key)] = ''
 
-            self.tube.add_signal_receiver(
-                self.__vote_cb, 'Vote', IFACE,
-                path=PATH,
-                sender_keyword='sender')
+            elif blob_hash is None:
+                images[int(key)] = self.get_pixbuf(image_buf)
 
-            self.tube.add_signal_receiver(
-                self.__helloback_cb, 'HelloBack',
-                IFACE, path=PATH,
-                sender_keyword='sender')
+            elif blob_hash in self.blobs:
+                images[int(key)] = self.blobs.get_pixbuf(blob_hash)
 
-            self.tube.add_signal_receiver(
-                self.__updatedpoll_cb, 'UpdatedPoll',
-                IFACE, path=PATH,
-                sender_keyword='sender')
+            else:
+                # Shown once GetImage returns it
+                images[int(key)] = ''
+                missing.append((int(key), blob_hash))
 
-            self.my_bus_name = self.tube.get_unique_name()
+        polls = self.activity._polls.find(author, title)
+        old_poll = None
+        if polls:
+            old_poll = polls[0]
 
-            self.entered = True
+        if base == pollsync.FULL:
+            # Named by its old title if the author renamed it
+            poll = Poll(self.activity, fields.get('title', title), author,
+                        fields['active'], fields['createdate'],
+                        fields['maxvoters'], fields['question'],
+                        fields['number_of_options'], fields['options'],
+                        fields['data'], dict(votes), images)
+            poll.sync_position = position
 
-    @signal(dbus_interface=IFACE, signature='')
-    def Hello(self):
-        """
-        Request that my UpdatePoll method is called to let me know about
-        other known polls.
-        """
+            if old_poll is not None:
+                poll.journal_identity = old_poll.journal_identity
 
-    @signal(dbus_interface=IFACE, signature='ssus')
-    def Vote(self, author, title, choice, votersha):
-        """
-        Send my vote on author's poll.
+            self.activity.update_poll(poll, old_poll)
+            self.__fetch_images(sender, poll, missing)
 
-        author -- string, buddy name
-        title -- string, poll title
-        choice -- integer 0-4, selected vote
-        votersha -- string, sha1 of voter's nick
-        """
+            if old_poll is None:
+                self.activity.get_alert(_('New Poll'),
+                                        _("%(author)s shared a poll "
+                                          "'%(title)s' with you.") %
+                                        {'author': author, 'title': title})
 
-    @signal(dbus_interface=IFACE, signature='s')
-    def HelloBack(self, recipient):
-        """
-        Respond to Hello.
+        elif old_poll is not None and old_poll.sync_position is not None \
+                and base <= old_poll.sync_position:
+            if old_poll.apply_update(fields, votes, images, position):
+                self.activity.update_poll(old_poll)
 
-        recipient -- string, sender of Hello.
-        """
+            self.__fetch_images(sender, old_poll, missing)
 
-    @signal(dbus_interface=IFACE, signature='ssuuusua{us}a{uu}a{su}a{us}')
-    def UpdatedPoll(self, title, author, active, createdate, maxvoters,
-                    question, number_of_options, options, data, votes,
-                    images_buf):
-        """
-        Broadcast a new poll to the mesh.
-        """
+        else:
+            self._logger.debug('Update of %s from version %d does not '
+                               'apply, asking for the whole poll' %
+                               (title, base))
+            self._calls.call(sender, 'PollWanted', author, title,
+                             dbus_interface=IFACE)
 
     def __hello_cb(self, sender=None):
         """
@@ -344,30 +1601,37 @@ class PollSession(ExportedGObject):
             # then I don't want to respond to my own Hello
             return
 
-        # Send my polls
-        for poll in self.activity.get_my_polls():
-            self._logger.debug('Telling %s about my %s' %
-                               (sender, poll.title))
+        # The buddies joining together are answered together
+        self._newcomers.add(sender)
 
-            # images_properties = poll.simplify_images_dictionary()
-            images_buf = {}
+        if self._newcomers_id is None:
+            self._newcomers_id = GLib.timeout_add(
+                random.randint(*HELLO_DELAY), self.__answer_newcomers)
 
-            for img_number, img_pixbuf in poll.images.iteritems():
-                if not img_pixbuf == '':
-                    images_buf[img_number] = poll.get_buffer(img_pixbuf)
+    def __answer_newcomers(self):
+        """
+        Send my polls to the buddies that sent Hello, and HelloBack to
+        ask for theirs.
+        """
 
-                else:
-                    images_buf[img_number] = img_pixbuf
+        self._newcomers_id = None
+        newcomers = list(self._newcomers)
+        self._newcomers.clear()
 
-            self.tube.get_object(sender, PATH).UpdatePoll(
-                poll.title, poll.author, int(poll.active),
-                poll.createdate.toordinal(),
-                poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, images_buf,
-                dbus_interface=IFACE)
+        # Send my polls
+        self.__send_polls(newcomers)
+
+        # Ask for other's polls back. The ones that know about deltas
+        # send theirs to everybody after the first HelloBack, older
+        # ones only to the buddies that send HelloBack.
+        for bus_name in newcomers:
+            if bus_name in self._delta_peers and \
+                    bus_name in self._answered:
+                continue
 
-        # Ask for other's polls back
-        self.HelloBack(sender)
+            self.HelloBack(bus_name)
+
+        return False
 
     def __helloback_cb(self, recipient, sender):
         """
@@ -385,47 +1649,89 @@ class PollSession(ExportedGObject):
             # Ignore my own signal
             return
 
+        # Somebody asked for the polls of recipient, no need to do it too
+        self._answered.add(str(recipient))
+
         if recipient != self.my_bus_name:
             # This is not for me
             return
 
         self._logger.debug('*** It was for me, so sending my polls back.')
 
-        for poll in self.activity.get_my_polls():
-            self._logger.debug('Telling %s about my %s' %
-                               (sender, poll.title))
+        if sender not in self._delta_peers:
+            self.__send_polls([sender])
+
+        else:
+            # Only one of them sends HelloBack, send to all at once. The
+            # ones I don't know about yet are sent them from SetFeatures.
+            self._hello_answered = True
+            self.__send_polls(
+                [bus_name for bus_name in self._participants.values()
+                 if bus_name in self._delta_peers])
+
+    def __live_images(self):
+        """
+        Return the sha1 of the images shown by my polls or sent by them
+        as references.
+        """
 
-            images_buf = {}
+        live = set()
 
-            for img_number, img_pixbuf in poll.images.iteritems():
-                if not img_pixbuf == '':
-                    images_buf[img_number] = poll.get_buffer(img_pixbuf)
+        for poll in self.activity._polls:
+            images = list(poll.images.itervalues())
 
-                else:
-                    images_buf[img_number] = img_pixbuf
+            if poll.author == self.activity.nick:
+                images.extend(poll.get_images_buf().itervalues())
 
-            self.tube.get_object(sender, PATH).UpdatePoll(
-                poll.title, poll.author, int(poll.active),
-                poll.createdate.toordinal(),
-                poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, images_buf,
-                dbus_interface=IFACE)
+            for image in images:
+                if image:
+                    live.add(self.blobs.get_hash(image))
+
+        return live
 
     def get_pixbuf(self, img_encode_buf):
+        """
+        Return the pixbuf of a base64 encoded image, shared with the
+        polls that have the same image.
+        """
+
+        return self.blobs.get_pixbuf(self.blobs.add_base64(img_encode_buf))
+
+    def __fetch_images(self, bus_name, poll, missing):
+        """
+        Ask bus_name for the images of poll that are not in the blob
+        store, once for every image.
+
+        missing -- list of (choice, sha1)
+        """
+
+        for choice, blob_hash in missing:
+            waiters = self._image_waiters.get(blob_hash)
+
+            if waiters is None:
+                waiters = self._image_waiters[blob_hash] = []
+                self._image_fetcher.fetch(bus_name, blob_hash,
+                                          self.__image_fetched_cb)
 
-        decode_img_buf = base64.b64decode(img_encode_buf)
-        loader = GdkPixbuf.PixbufLoader()
-        loader.write(decode_img_buf)
-        loader.close()
-        pixbuf = loader.get_pixbuf()
+            waiters.append((poll, choice))
 
-        return pixbuf
+    def __image_fetched_cb(self, blob_hash, pixbuf):
+
+        waiters = self._image_waiters.pop(blob_hash, [])
+
+        if pixbuf is None:
+            return
+
+        for poll, choice in waiters:
+            if poll in self.activity._polls:
+                poll.images[choice] = pixbuf
+                self.activity.update_poll(poll)
 
     def __updatedpoll_cb(self, title, author, active, createdate, maxvoters,
                          question, number_of_options, options_d, data_d,
                          votes_d, images_buf_d, sender):
         """
-        Handle an UpdatedPoll signal by creating a new Poll.
+        Handle an UpdatedPoll signal, see __receive_poll.
         """
 
         self._logger.debug('Received UpdatedPoll from %s' % sender)
@@ -434,10 +1740,29 @@ class PollSession(ExportedGObject):
             # Ignore my own signal
             return
 
-        # We get the parameters as dbus types. These are not serialisable
-        # with pickle at the moment, so convert them to builtin types.
-        # Pay special attention to dicts - we need to convert the keys
-        # and values too.
+        if sender in self._delta_peers:
+            # It sends me PollDelta and SyncPoll instead
+            return
+
+        self.__receive_poll(title, author, active, createdate, maxvoters,
+                            question, number_of_options, options_d, data_d,
+                            votes_d, images_buf_d)
+
+    def __receive_poll(self, title, author, active, createdate, maxvoters,
+                       question, number_of_options, options_d, data_d,
+                       votes_d, images_buf_d):
+        """
+        Store a poll sent with UpdatePoll or UpdatedPoll.
+
+        The poll is resent every time somebody says Hello, so a poll I
+        already have is updated in place, unless it has more votes than
+        the one received.
+
+            We get the parameters as dbus types. These are not serialisable
+            with pickle at the moment, so convert them to builtin types.
+            Pay special attention to dicts - we need to convert the keys
+            and values too.
+        """
 
         title = str(title)
         author = str(author)
@@ -464,22 +1789,56 @@ class PollSession(ExportedGObject):
             value = votes_d[key]
             votes[str(key)] = int(value)
 
-        images = {}
+        images_buf = {}
 
         for key in images_buf_d:
-            if not images_buf_d[key] == '':
-                images[int(key)] = self.get_pixbuf(images_buf_d[key])
+            images_buf[int(key)] = str(images_buf_d[key])
+
+        polls = self.activity._polls.find(author, title)
+        poll = None
+        if polls:
+            poll = polls[0]
+
+        images = {}
+
+        for choice, image_buf in images_buf.iteritems():
+            if poll is not None and poll.has_image_buf(choice, image_buf):
+                # Sent again, it is already decoded
+                continue
+
+            if image_buf == '':
+                images[choice] = ''
 
             else:
-                images[int(key)] = ''
+                images[choice] = self.get_pixbuf(image_buf)
+
+        if poll is not None:
+            if sum(data.values()) < poll.vote_count:
+                self._logger.debug('Ignoring older copy of %s by %s' %
+                                   (title, author))
+                return
+
+            changed = poll.apply_update(
+                {'active': active, 'createdate': createdate,
+                 'maxvoters': maxvoters, 'question': question,
+                 'number_of_options': number_of_options,
+                 'options': options, 'data': data},
+                votes.items(), images, poll.sync_position)
+            poll.set_images_buf(images_buf)
+
+            if changed:
+                self.activity.update_poll(poll)
+
+            return
 
         poll = Poll(self.activity, title, author, active,
                     createdate, maxvoters, question, number_of_options,
                     options, data, votes, images)
+        poll.set_images_buf(images_buf)
 
-        self.activity._polls.add(poll)
+        self.activity.add_poll(poll)
 
-        self.activity.get_alert(('New Poll'),
+        self.activity.get_alert(_('New Poll'),
                                 _("%(author)s shared a poll "
                                   "'%(title)s' with you.") %
                                 {'author': author, 'title': title})
@@ -501,11 +1860,103 @@ class PollSession(ExportedGObject):
             # Don't respond to my own Vote signal
             return
 
+        if sender in self._vote_batch_peers:
+            # It sends every vote in a VoteBatch too
+            return
+
         self._logger.debug('In vote_cb. sender: %r' % sender)
         self._logger.debug('%s voted %d on %s by %s' % (votersha, choice,
                            title, author))
 
-        self.activity.vote_on_poll(author, title, choice, votersha)
+        vote = (str(author), str(title), str(votersha), int(choice))
+        unbatched = self._unbatched_votes.get(sender)
+
+        if unbatched is None:
+            unbatched = self._unbatched_votes[sender] = \
+                deque(maxlen=VOTE_HISTORY)
+
+        unbatched.append(vote)
+        self.__queue_votes([vote])
+
+    def __vote_batch_cb(self, first, votes, sender=None):
+        """
+        Receive the votes of sender, and ask for the ones I missed.
+        """
+
+        if sender == self.my_bus_name:
+            return
+
+        # Its Vote signals are ignored from now on
+        self._vote_batch_peers.add(sender)
+
+        first = int(first)
+        expected = self._vote_seqs.get(sender)
+
+        if expected is not None:
+            if first > expected:
+                self._logger.debug('Missed votes %d to %d from %s' %
+                                   (expected, first - 1, sender))
+                self._calls.call(sender, 'GetVotes', expected,
+                                 first - expected, dbus_interface=IFACE,
+                                 reply_handler=self.__queue_votes)
+
+            elif first < expected:
+                # Sent again, some of them were already applied
+                votes = votes[expected - first:]
+                first = expected
+
+        self._vote_seqs[sender] = first + len(votes)
+
+        votes = [(str(author), str(title), str(votersha), int(choice))
+                 for author, title, votersha, choice in votes]
+        unbatched = self._unbatched_votes.get(sender)
+
+        if unbatched:
+            # Votes come in the same order with both signals, the Vote
+            # first, so the ones already applied are at the head
+            batch = []
+
+            for vote in votes:
+                if unbatched and unbatched[0] == vote:
+                    unbatched.popleft()
+
+                else:
+                    batch.append(vote)
+
+            votes = batch
+
+        if not unbatched:
+            self._unbatched_votes.pop(sender, None)
+
+        self.__queue_votes(votes)
+
+    def __queue_votes(self, votes):
+        """
+        Apply votes from the mesh, the ones arriving together as one
+        batch from idle.
+
+        votes -- list of (author, title, votersha, choice)
+        """
+
+        for author, title, votersha, choice in votes:
+            self._pending_votes.setdefault(
+                (str(author), str(title)), []).append(
+                    (int(choice), str(votersha)))
+
+        if self._pending_votes and self._pending_votes_id is None:
+            self._pending_votes_id = GObject.idle_add(
+                self.__apply_pending_votes)
+
+    def __apply_pending_votes(self):
+
+        self._pending_votes_id = None
+        pending = self._pending_votes
+        self._pending_votes = OrderedDict()
+
+        for (author, title), votes in pending.iteritems():
+            self.activity.vote_on_poll_batch(author, title, votes)
+
+        return False
 
     @method(dbus_interface=IFACE, in_signature='ssuuusua{us}a{uu}a{su}a{us}',
             out_signature='')
@@ -514,79 +1965,105 @@ class PollSession(ExportedGObject):
                    images_buf_d):
         """
         To be called on the incoming buddy by the other participants
-        to inform you of their polls and state.
+        to inform you of their polls and state, see __receive_poll.
+        """
 
-            We get the parameters as dbus types. These are not serialisable
-            with pickle at the moment, so convert them to builtin types.
-            Pay special attention to dicts - we need to convert the keys
-            and values too.
+        self.__receive_poll(title, author, active, createdate, maxvoters,
+                            question, number_of_options, options_d, data_d,
+                            votes_d, images_buf_d)
+
+    @method(dbus_interface=IFACE, in_signature='s', out_signature='')
+    def PollsWanted(self, sender):
+        """
+        Notification to send my polls to sender.
         """
 
-        title = str(title)
-        author = str(author)
-        active = bool(active)
-        createdate = date.fromordinal(int(createdate))
-        maxvoters = int(maxvoters)
-        question = str(question)
-        number_of_options = int(number_of_options)
+        self.__send_polls([sender])
 
-        options = {}
+    @method(dbus_interface=IFACE, in_signature='as', out_signature='',
+            sender_keyword='sender')
+    def SetFeatures(self, features, sender=None):
+        """
+        Answer to my Features signal, with the features of sender.
+        """
 
-        for key in options_d:
-            value = options_d[key]
-            options[int(key)] = str(value)
+        self.__add_features(sender, features)
 
-        data = {}
+        if self._hello_answered and sender in self._delta_peers:
+            # It may not have sent HelloBack, because somebody else did
+            self.__send_polls([sender])
 
-        for key in data_d:
-            value = data_d[key]
-            data[int(key)] = int(value)
+    @method(dbus_interface=IFACE, in_signature='ssuua{sv}a(su)a{us}',
+            out_signature='', sender_keyword='sender')
+    def SyncPoll(self, author, title, base, position, fields, votes,
+                 images_buf, sender=None):
+        """
+        Receive a poll, or its changes since version base, from its
+        author. See PollDelta.
+        """
 
-        votes = {}
+        self.__apply_update(author, title, base, position, fields, votes,
+                            images_buf, sender)
 
-        for key in votes_d:
-            value = votes_d[key]
-            votes[str(key)] = int(value)
+    @method(dbus_interface=IFACE, in_signature='uaya{us}', out_signature='',
+            sender_keyword='sender', byte_arrays=True)
+    def SyncPollPacked(self, position, record, images_buf, sender=None):
+        """
+        Receive a whole poll from its author as a compressed record. See
+        PollPacked.
+        """
 
-        images = {}
+        self.__apply_packed(position, record, images_buf, sender, False)
 
-        for key in images_buf_d:
-            if not images_buf_d[key] == '':
-                images[int(key)] = self.get_pixbuf(images_buf_d[key])
+    @method(dbus_interface=IFACE, in_signature='suu', out_signature='ay')
+    def GetImageChunk(self, blob_hash, offset, size):
+        """
+        Return size bytes, at most MAX_CHUNK_SIZE, of the PNG data of an
+        image I sent by reference, from offset. Fewer bytes than size
+        are returned at the end of the data.
+        """
 
-            else:
-                images[int(key)] = ''
+        data = self.blobs.get(str(blob_hash))
 
-        poll = Poll(self.activity, title, author, active,
-                    createdate, maxvoters, question, number_of_options,
-                    options, data, votes, images)
+        if data is None:
+            raise KeyError('No image %s' % blob_hash)
 
-        self.activity._polls.add(poll)
+        size = min(int(size), MAX_CHUNK_SIZE)
 
-        self.activity.get_alert(_('New Poll'),
-                                _("%(author)s shared a poll "
-                                  "'%(title)s' with you.") %
-                                {'author': author, 'title': title})
+        return dbus.ByteArray(data[int(offset):int(offset) + size])
 
-    @method(dbus_interface=IFACE, in_signature='s', out_signature='')
-    def PollsWanted(self, sender):
+    @method(dbus_interface=IFACE, in_signature='ss', out_signature='',
+            sender_keyword='sender')
+    def PollWanted(self, author, title, sender=None):
         """
-        Notification to send my polls to sender.
+        Send the whole poll to sender, its copy can not be updated.
+        title may be the one sender was last sent, before I renamed the
+        poll.
         """
 
-        for poll in self.activity.get_my_polls():
-            images_buf = {}
+        title = str(title)
 
-            for img_number, img_pixbuf in poll.images.iteritems():
-                if not img_pixbuf == '':
-                    images_buf[img_number] = poll.get_buffer(img_pixbuf)
+        for poll in self.activity._polls.by_author(str(author)):
+            state = self._sent.get((sender, poll))
 
-                else:
-                    images_buf[img_number] = img_pixbuf
-
-            self.tube.get_object(sender, PATH).UpdatePoll(
-                poll.title, poll.author, int(poll.active),
-                poll.createdate.toordinal(),
-                poll.maxvoters, poll.question, poll.number_of_options,
-                poll.options, poll.data, poll.votes, images_buf,
-                dbus_interface=IFACE)
+            if poll.author == self.activity.nick and (
+                    poll.title == title or
+                    (state is not None and
+                     pollsync.get_title(state) == title)):
+                self.__sync_poll(sender, poll, full=True)
+
+    @method(dbus_interface=IFACE, in_signature='uu', out_signature='a(sssu)')
+    def GetVotes(self, first, count):
+        """
+        Return the votes I sent with VoteBatch from sequence number
+        first, at most count of them. The oldest ones are forgotten
+        after VOTE_HISTORY votes.
+        """
+
+        start = self._vote_seq - len(self._vote_history)
+        first = max(int(first), start)
+        end = min(first + int(count), self._vote_seq)
+
+        return dbus.Array([self._vote_history[seq - start]
+                           for seq in xrange(first, end)],
+                          signature='(sssu)')
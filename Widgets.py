@@ -26,7 +26,6 @@ from gettext import gettext as _
 
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository import GdkPixbuf
 from gi.repository import GObject
 from gi.repository import Pango
 
@@ -341,7 +340,7 @@ class NewPollCanvas(Gtk.EventBox):
         """
         # Data OK
         self._poll.active = True
-        self._poll.activity._polls.add(self._poll)
+        self._poll.activity.add_poll(self._poll)
         self._poll.broadcast_on_mesh()
         self._poll.activity.set_canvas(self._poll.activity._poll_canvas())
 
@@ -540,6 +539,7 @@ class ItemOptionNewPoll(Gtk.Box):
         self.pack_start(self.entry, True, True, 0)
 
         self._image = Gtk.Image()
+        self._thumbnail_request = None
         self.pack_start(self._image, False, False, 10)
 
         self._image_button = Gtk.Button()
@@ -604,18 +604,15 @@ class ItemOptionNewPoll(Gtk.Box):
                 if jobject and jobject.file_path and \
                    jobject.metadata.get('mime_type') in images_mime_types:
 
-                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                        jobject.file_path,
-                        self._poll.activity._image_size['height'],
-                        self._poll.activity._image_size['width'])
-
-                    self._poll.images[self.field] = pixbuf
-
                     self._poll.images_ds_objects[self.field]['id'] = \
                         jobject.object_id
 
-                    self._poll.images_ds_objects[self.field]['file_path'] = \
-                        jobject.file_path
+                    # Keeps the file for get_image_file_path
+                    self._poll.activity.datastore_cache.put(jobject)
+
+                    # Decoded in the background, see Poll.request_image
+                    self._poll.images[self.field] = None
+                    self._poll.request_image(self.field, self.__noop_cb)
 
                     self.__show_image_thumbnail()
 
@@ -628,19 +625,32 @@ class ItemOptionNewPoll(Gtk.Box):
             chooser.destroy()
             del chooser
 
+    def __noop_cb(self, pixbuf):
+        pass
+
     def __show_image_thumbnail(self):
 
-        image_file_path = self._poll.images_ds_objects[self.field][
-            'file_path']
+        image_file_path = self._poll.get_image_file_path(self.field)
+
+        if self._thumbnail_request is not None:
+            self._thumbnail_request.cancel()
+            self._thumbnail_request = None
 
         if image_file_path:
-            pixbuf_thumbnail = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                image_file_path, 80, 80)
+            decoder = self._poll.activity.image_decoder
+            self._thumbnail_request = decoder.decode_thumbnail(
+                self._poll.get_image_thumbnail_path(self.field, 80, 80),
+                image_file_path, 80, 80, self.__thumbnail_decoded_cb)
+        else:
+            self._image.hide()
+
+    def __thumbnail_decoded_cb(self, pixbuf_thumbnail):
+
+        self._thumbnail_request = None
 
+        if pixbuf_thumbnail is not None:
             self._image.set_from_pixbuf(pixbuf_thumbnail)
             self._image.show()
-        else:
-            self._image.hide()
 
 
 class OptionsPalette(Gtk.Box):
@@ -723,11 +733,13 @@ class OptionsPalette(Gtk.Box):
 
     def __play_vote_sound_checkbox_cb(self, checkbox):
         self._poll_activity._play_vote_sound = checkbox.get_active()
+        self._poll_activity.autosave.changed()
 
     def __entry_image_size_cb(self, entrycontrol, data):
         text = entrycontrol.get_text()
         if text:
             self._poll_activity._image_size[data] = int(text)
+            self._poll_activity.autosave.changed()
 
     def __use_image_checkbox_cb(self, checkbox):
         self._poll_activity.set_use_image(checkbox.get_active())
@@ -880,6 +892,8 @@ class PollCanvas(Gtk.EventBox):
         self.add(box)
 
         self._poll = poll
+        # Images being decoded for this canvas
+        self._image_requests = []
 
         self._grid = Gtk.Grid()
         box.pack_start(self._grid, True, True, 0)
@@ -971,7 +985,20 @@ class PollCanvas(Gtk.EventBox):
                 if choice == current_vote:
                     button.set_active(True)
 
-                if poll.images[int(choice)]:
+                if poll.image_pending(choice):
+                    # Show an empty space until the image is decoded
+                    image = Gtk.Image()
+                    image.set_size_request(
+                        poll.activity._image_size['width'],
+                        poll.activity._image_size['height'])
+                    image.set_halign(Gtk.Align.START)
+                    self.tabla.attach(image, 1, 2, row, row + 1)
+                    request = poll.request_image(
+                        choice, self.__image_decoded_cb, image)
+                    if request is not None:
+                        self._image_requests.append(request)
+
+                elif poll.images[int(choice)]:
                     image = Gtk.Image()
                     image.set_from_pixbuf(poll.images[choice])
                     image.set_halign(Gtk.Align.START)
@@ -1036,6 +1063,24 @@ class PollCanvas(Gtk.EventBox):
         # hide or show the results if needed
         self.set_view_answer(view_answer or not poll.active)
 
+    def __image_decoded_cb(self, pixbuf, image):
+        """
+        Show a decoded image in place of its placeholder.
+        """
+
+        if pixbuf:
+            image.set_from_pixbuf(pixbuf)
+
+    def cancel_image_loading(self):
+        """
+        Stop decoding images for this canvas, it is being replaced.
+        """
+
+        for request in self._image_requests:
+            request.cancel()
+
+        self._image_requests = []
+
     def __vote_radio_button_cb(self, button, data):
         """
         Track which radio button has been selected
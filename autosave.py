@@ -0,0 +1,220 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import uuid
+import logging
+import threading
+
+from gi.repository import GLib
+
+import journalformat
+
+
+class AutoSave(object):
+    """
+    Save the activity to the journal a while after it changes.
+
+    All the changes made during interval seconds are saved together.
+    The state of the polls is copied on the main loop, then encoded and
+    written to a file in the instance directory on a worker thread.
+    Back on the main loop, Activity.save is called and write_file moves
+    that file in place, unless something changed in between.
+    """
+
+    def __init__(self, activity, path, interval=30):
+        """
+        activity -- the PollBuilder
+        path -- string, where the snapshots are written before they are
+          handed to write_file
+        interval -- seconds between a change and its save
+        """
+
+        self._logger = logging.getLogger('poll-activity.AutoSave')
+        self._activity = activity
+        self._path = path
+        self.interval = interval
+
+        self._timeout_id = None
+        self._thread = None
+        # (snapshot_id, state) of the file in self._path
+        self._staged = None
+        # The activity is closing, it saves itself one last time
+        self._closed = False
+
+        self.saves = 0
+        # Seconds spent copying the polls on the main loop, and
+        # encoding and writing them on the worker thread
+        self.last_copy_time = 0
+        self.last_write_time = 0
+        self.total_copy_time = 0
+        self.total_write_time = 0
+        self.max_copy_time = 0
+        self.max_write_time = 0
+
+    def changed(self):
+        """
+        Something to save changed, schedule a save if there is none.
+        """
+
+        if self._timeout_id is None and not self._closed:
+            self._timeout_id = GLib.timeout_add_seconds(
+                self.interval, self.__timeout_cb)
+
+    def cancel(self):
+
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def close(self):
+        """
+        Stop saving, the snapshot being written is not handed to
+        Activity.save.
+        """
+
+        self.cancel()
+        self._closed = True
+
+    def use_snapshot(self, file_path):
+        """
+        Move the snapshot written in the background to file_path if it
+        is still up to date. Return its snapshot id, or None.
+        """
+
+        if self._staged is None or self._thread is not None:
+            return None
+
+        snapshot_id, state = self._staged
+        self._staged = None
+
+        if state != self.__get_state():
+            return None
+
+        try:
+            os.rename(self._path, file_path)
+
+        except OSError, e:
+            self._logger.error('Can not use %s: %s' % (self._path, e))
+            return None
+
+        return snapshot_id
+
+    def get_stats(self):
+        """
+        Return a dict with the number of saves and the last, mean and
+        maximum seconds spent on the main loop and on the worker.
+        """
+
+        saves = max(self.saves, 1)
+
+        return {'saves': self.saves,
+                'last_copy_time': self.last_copy_time,
+                'mean_copy_time': self.total_copy_time / saves,
+                'max_copy_time': self.max_copy_time,
+                'last_write_time': self.last_write_time,
+                'mean_write_time': self.total_write_time / saves,
+                'max_write_time': self.max_write_time}
+
+    def __timeout_cb(self):
+
+        self._timeout_id = None
+
+        if self._thread is not None:
+            # Still writing the previous snapshot, try again later
+            self.changed()
+            return False
+
+        start = time.time()
+
+        settings = self._activity.get_settings()
+        settings['snapshot_id'] = uuid.uuid4().hex
+        polls = [(poll, ) + poll.snapshot()
+                 for poll in self._activity._polls]
+        state = self.__get_state()
+
+        self.last_copy_time = time.time() - start
+        self.total_copy_time += self.last_copy_time
+        self.max_copy_time = max(self.max_copy_time, self.last_copy_time)
+
+        self._staged = None
+        self._thread = threading.Thread(
+            target=self.__write, args=(settings, polls, state))
+        self._thread.daemon = True
+        self._thread.start()
+
+        return False
+
+    def __write(self, settings, polls, state):
+
+        start = time.time()
+        records = []
+
+        try:
+            for poll, version, record, data in polls:
+                if record is None:
+                    record = journalformat.encode_poll(data, True)
+
+                records.append((poll, version, record))
+
+            with open(self._path, 'wb') as f:
+                journalformat.write(f, settings,
+                                    [record for poll, version, record
+                                     in records], True)
+
+        except Exception, e:
+            # Anything left uncaught here would keep _thread set, and
+            # stop every autosave after this one
+            self._logger.error('Autosave failed: %s' % e)
+            records = None
+
+        GLib.idle_add(self.__written_cb, settings['snapshot_id'], state,
+                      records, time.time() - start)
+
+    def __written_cb(self, snapshot_id, state, records, write_time):
+
+        self._thread = None
+
+        if records is None:
+            return False
+
+        for poll, version, record in records:
+            poll.set_binary_cache(version, record)
+
+        if self._closed:
+            return False
+
+        self.saves += 1
+        self.last_write_time = write_time
+        self.total_write_time += write_time
+        self.max_write_time = max(self.max_write_time, write_time)
+
+        self._logger.debug('Autosave %d: %.3f s copying, %.3f s writing' %
+                           (self.saves, self.last_copy_time, write_time))
+
+        self._staged = (snapshot_id, state)
+        self._activity.save()
+
+        return False
+
+    def __get_state(self):
+        """
+        Something that changes when there is anything new to save.
+        """
+
+        settings = self._activity.get_settings()
+
+        return (sorted(settings.items()),
+                [(poll, poll.version) for poll in self._activity._polls])
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Compare the journal formats on a big journal entry.
+
+Usage: python benchmarks/journal_formats.py [number_of_polls]
+                                            [votes_per_poll]
+
+Saves and loads the same polls, as Poll.dump() style data, in the JSON
+format, the binary format with and without compression, and the legacy
+pickle format, and prints the time taken and the size of every file.
+"""
+
+import os
+import sys
+import time
+import cPickle
+import tempfile
+
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import journalformat  # noqa
+
+SETTINGS = {'view_answer': True, 'remember_last_vote': True,
+            'play_vote_sound': False, 'use_image': False,
+            'image_size': {'height': 100, 'width': 100}}
+
+
+def poll_data(number, votes_per_poll):
+
+    votes = {}
+    log = {'voter_shas': [], 'choices': [], 'voters': [], 'times': []}
+
+    for voter in range(votes_per_poll):
+        votersha = '%040x' % voter
+        votes[votersha] = voter % 5
+        log['voter_shas'].append(votersha)
+        log['choices'].append(voter % 5)
+        log['voters'].append(voter)
+        log['times'].append(1400000000.0 + voter)
+
+    return {'title': 'Poll %d' % number,
+            'author': 'author %d' % (number % 30),
+            'active': True,
+            'createdate': date.today().toordinal(),
+            'maxvoters': votes_per_poll,
+            'question': 'What is the answer to question %d?' % number,
+            'number_of_options': 5,
+            'options': {0: 'Yes', 1: 'No', 2: 'Maybe', 3: 'Later',
+                        4: 'Never'},
+            'data': {0: 0, 1: 0, 2: 0, 3: 0, 4: 0},
+            'votes': votes,
+            'vote_log': log,
+            'images_ds_objects': {0: '', 1: '', 2: '', 3: '', 4: ''}}
+
+
+def save_json(path, polls):
+    with open(path, 'w') as f:
+        journalformat.write_json(f, SETTINGS, polls)
+
+
+def load_json(path):
+    with open(path, 'r') as f:
+        return journalformat.read_json(f)
+
+
+def save_binary(path, polls, compress):
+    records = [journalformat.encode_poll(poll, compress) for poll in polls]
+    with open(path, 'wb') as f:
+        journalformat.write(f, SETTINGS, records, compress)
+
+
+def load_binary(path):
+    with open(path, 'rb') as f:
+        return journalformat.read(f)
+
+
+def save_pickle(path, polls):
+    # The layout read by PollBuilder._old_read_file
+    with open(path, 'w') as f:
+        cPickle.dump(len(polls), f)
+        cPickle.dump(SETTINGS, f)
+        cPickle.dump(SETTINGS['image_size'], f)
+        for poll in polls:
+            for field in ('title', 'author', 'active', 'createdate',
+                          'maxvoters', 'question', 'number_of_options',
+                          'options', 'data', 'votes', 'images_ds_objects'):
+                cPickle.dump(poll[field], f)
+
+
+def load_pickle(path):
+    with open(path, 'r') as f:
+        polls = []
+        count = cPickle.load(f)
+        cPickle.load(f)
+        cPickle.load(f)
+        for number in range(count):
+            polls.append([cPickle.load(f) for field in range(11)])
+        return polls
+
+
+def measure(name, save, load, polls):
+
+    path = tempfile.mktemp(prefix='poll-bench-')
+
+    try:
+        start = time.time()
+        save(path, polls)
+        saved = time.time()
+        load(path)
+        loaded = time.time()
+
+        print('%-16s save %8.2f s   load %8.2f s   size %10d KiB' %
+              (name, saved - start, loaded - saved,
+               os.path.getsize(path) / 1024))
+
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def main():
+
+    number_of_polls = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    votes_per_poll = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    print('%d polls, %d votes each' % (number_of_polls, votes_per_poll))
+    polls = [poll_data(number, votes_per_poll)
+             for number in range(number_of_polls)]
+
+    measure('json', save_json, load_json, polls)
+    measure('binary', lambda path, polls: save_binary(path, polls, False),
+            load_binary, polls)
+    measure('binary + zlib', lambda path, polls: save_binary(path, polls,
+                                                            True),
+            load_binary, polls)
+    measure('pickle (legacy)', save_pickle, load_pickle, polls)
+
+
+if __name__ == '__main__':
+    main()
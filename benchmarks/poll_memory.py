@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Measure the memory used by the polls of a big journal entry.
+
+Usage: python benchmarks/poll_memory.py [number_of_polls] [votes_per_poll]
+
+Builds the polls the way PollBuilder.read_file does, from Poll.dump()
+style data, and prints the growth of the process resident size.
+"""
+
+import os
+import sys
+import gc
+import time
+import resource
+
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from PollSession import Poll  # noqa
+
+
+class FakeActivity(object):
+
+    poll_session = None
+    nick_sha1 = ''
+    _polls = ()
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def poll_data(number, votes_per_poll):
+
+    votes = {}
+    for voter in range(votes_per_poll):
+        votes['%040x' % voter] = voter % 5
+
+    return {'title': 'Poll %d' % number,
+            'author': 'author %d' % (number % 30),
+            'active': True,
+            'createdate': date.today().toordinal(),
+            'maxvoters': 1000,
+            'question': 'What is the answer to question %d?' % number,
+            'number_of_options': 5,
+            'options': {0: 'Yes', 1: 'No', 2: 'Maybe', 3: 'Later',
+                        4: 'Never'},
+            'data': {0: 0, 1: 0, 2: 0, 3: 0, 4: 0},
+            'votes': votes,
+            'images_ds_objects': {0: '', 1: '', 2: '', 3: '', 4: ''}}
+
+
+def main():
+
+    number_of_polls = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    votes_per_poll = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    activity = FakeActivity()
+    documents = [poll_data(number, votes_per_poll)
+                 for number in range(number_of_polls)]
+
+    gc.collect()
+    before = max_rss_kb()
+    start = time.time()
+
+    polls = []
+    for data in documents:
+        polls.append(Poll(
+            activity, data['title'], data['author'], data['active'],
+            date.fromordinal(data['createdate']), data['maxvoters'],
+            data['question'], data['number_of_options'], data['options'],
+            data['data'], data['votes'], None, data['images_ds_objects']))
+
+    elapsed = time.time() - start
+    gc.collect()
+    grown = max_rss_kb() - before
+
+    print('%d polls, %d votes each' % (number_of_polls, votes_per_poll))
+    print('load time: %.3f s' % elapsed)
+    print('resident size growth: %d KiB (%.0f bytes per poll)' %
+          (grown, grown * 1024.0 / max(number_of_polls, 1)))
+
+
+if __name__ == '__main__':
+    main()
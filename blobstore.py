@@ -0,0 +1,200 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import base64
+import logging
+
+from collections import OrderedDict
+from hashlib import sha1
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+# Images sent by reference are 'sha1:' and the hex digest of the PNG data
+REF_PREFIX = 'sha1:'
+
+# Bytes of PNG data kept before the least recently used images that no
+# poll shows are forgotten
+MAX_SIZE = 8 * 1024 * 1024
+
+
+class BlobStore(object):
+    """
+    The PNG images sent and received over the tube, by sha1.
+
+    The same image is kept, and decoded, once however many polls use
+    it. When the PNG data takes more than max_size bytes, the least
+    recently used images are forgotten, but not the ones get_live says
+    are in use.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, get_live=None):
+        """
+        get_live -- function returning the sha1 of the images in use
+        """
+
+        self._logger = logging.getLogger('poll-activity.BlobStore')
+        self._max_size = max_size
+        self._get_live = get_live
+        self._size = 0
+        self._blobs = OrderedDict()  # sha1 -> PNG data, oldest first
+        self._pixbufs = {}  # sha1 -> pixbuf
+        self._pixbuf_hashes = {}  # id of pixbuf -> sha1
+        # The base64 strings of Poll.get_images_buf, that are cached too
+        self._hashes = {}  # sha1 digest of base64 -> sha1
+
+    def __contains__(self, blob_hash):
+        return blob_hash in self._blobs
+
+    def add(self, data, pixbuf=None):
+        """
+        Keep the PNG data, and the pixbuf decoded from it if there is
+        one, and return its sha1.
+        """
+
+        blob_hash = sha1(data).hexdigest()
+
+        if blob_hash in self._blobs:
+            self.__touch(blob_hash)
+
+        else:
+            self._blobs[blob_hash] = data
+            self._size += len(data)
+
+        if pixbuf is not None and blob_hash not in self._pixbufs:
+            self.__set_pixbuf(blob_hash, pixbuf)
+
+        if self._size > self._max_size:
+            self.__evict(blob_hash)
+
+        return blob_hash
+
+    def add_base64(self, image_buf):
+        """
+        Keep the base64 encoded PNG data and return its sha1.
+        """
+
+        key = sha1(image_buf).digest()
+        blob_hash = self._hashes.get(key)
+
+        if blob_hash is None or blob_hash not in self._blobs:
+            blob_hash = self._hashes[key] = \
+                self.add(base64.b64decode(image_buf))
+
+        return blob_hash
+
+    def get_hash(self, image):
+        """
+        Return the sha1 of image, a pixbuf from this store or a base64
+        encoded image added to it, or None.
+        """
+
+        if isinstance(image, basestring):
+            return self._hashes.get(sha1(image).digest())
+
+        return self._pixbuf_hashes.get(id(image))
+
+    def get(self, blob_hash):
+        """
+        Return the PNG data with blob_hash, or None.
+        """
+
+        if blob_hash in self._blobs:
+            self.__touch(blob_hash)
+
+        return self._blobs.get(blob_hash)
+
+    def get_pixbuf(self, blob_hash):
+        """
+        Return the image with blob_hash as a pixbuf, '' if it can not
+        be decoded, or None if there is no such image.
+        """
+
+        pixbuf = self._pixbufs.get(blob_hash)
+
+        if pixbuf is None:
+            data = self._blobs.get(blob_hash)
+
+            if data is None:
+                return None
+
+            try:
+                loader = GdkPixbuf.PixbufLoader()
+                loader.write(data)
+                loader.close()
+                pixbuf = loader.get_pixbuf()
+
+            except GLib.GError, e:
+                self._logger.debug('Can not decode %s: %s' % (blob_hash, e))
+                pixbuf = ''
+
+            self.__set_pixbuf(blob_hash, pixbuf)
+
+        return pixbuf
+
+    def __set_pixbuf(self, blob_hash, pixbuf):
+
+        self._pixbufs[blob_hash] = pixbuf
+
+        if pixbuf:
+            self._pixbuf_hashes[id(pixbuf)] = blob_hash
+
+    def __touch(self, blob_hash):
+
+        self._blobs[blob_hash] = self._blobs.pop(blob_hash)
+
+    def __evict(self, keep):
+        """
+        Forget the least recently used images but keep and the live ones,
+        down to three quarters of max_size.
+        """
+
+        live = set()
+        if self._get_live is not None:
+            live.update(self._get_live())
+
+        for blob_hash in self._blobs.keys():
+            if self._size <= self._max_size * 3 / 4:
+                break
+
+            if blob_hash == keep or blob_hash in live:
+                continue
+
+            self._size -= len(self._blobs.pop(blob_hash))
+            pixbuf = self._pixbufs.pop(blob_hash, None)
+
+            if pixbuf:
+                del self._pixbuf_hashes[id(pixbuf)]
+
+        for key, blob_hash in self._hashes.items():
+            if blob_hash not in self._blobs:
+                del self._hashes[key]
+
+        self._logger.debug('Images evicted, %d bytes left' % self._size)
+
+
+def make_ref(blob_hash):
+    return REF_PREFIX + blob_hash
+
+
+def get_ref_hash(image_buf):
+    """
+    Return the sha1 of an image sent by reference, or None if
+    image_buf is the image itself.
+    """
+
+    if image_buf.startswith(REF_PREFIX):
+        return image_buf[len(REF_PREFIX):]
+
+    return None
@@ -0,0 +1,160 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+
+from collections import OrderedDict
+
+from sugar3.datastore import datastore
+
+
+class DatastoreCache(object):
+    """
+    The journal objects used lately, by object id.
+
+    Every datastore.get is a D-Bus call to the datastore, and every
+    object keeps its own copy of the file, so the polls sharing an image
+    share one object. The least recently used objects are destroyed
+    when there are more than size, and the objects changed or deleted
+    in the journal are dropped. The objects whose file is pinned are
+    only destroyed once it is unpinned.
+    """
+
+    def __init__(self, size=64):
+
+        self._logger = logging.getLogger('poll-activity.DatastoreCache')
+        self._size = size
+        self._objects = OrderedDict()  # object id -> DSObject
+        self._pins = {}  # file path -> count
+        # Dropped objects with a pinned file, to destroy on unpin
+        self._doomed = {}  # file path -> list of DSObject
+
+        datastore.updated.connect(self.__changed_cb)
+        datastore.deleted.connect(self.__changed_cb)
+
+    def get(self, object_id):
+        """
+        Return the DSObject with object_id, or None if it is not in the
+        datastore.
+        """
+
+        jobject = self._objects.pop(object_id, None)
+
+        if jobject is None:
+            try:
+                jobject = datastore.get(object_id)
+
+            except Exception, e:
+                self._logger.debug('Can not get %s: %s' % (object_id, e))
+                return None
+
+        self.put(jobject)
+
+        return jobject
+
+    def put(self, jobject):
+        """
+        Add a DSObject that was got some other way, like from the
+        object chooser.
+        """
+
+        object_id = jobject.object_id
+        old_jobject = self._objects.pop(object_id, None)
+
+        if old_jobject is not None and old_jobject is not jobject:
+            self.__destroy(old_jobject)
+
+        self._objects[object_id] = jobject
+
+        while len(self._objects) > self._size:
+            object_id, evicted = self._objects.popitem(last=False)
+            self.__destroy(evicted)
+
+    def pin(self, file_path):
+        """
+        Keep the object of file_path until unpin is called, something
+        is reading the file.
+        """
+
+        self._pins[file_path] = self._pins.get(file_path, 0) + 1
+
+    def unpin(self, file_path):
+
+        count = self._pins.pop(file_path, 0) - 1
+
+        if count > 0:
+            self._pins[file_path] = count
+            return
+
+        for jobject in self._doomed.pop(file_path, []):
+            jobject.destroy()
+
+    def get_file_path(self, object_id):
+        """
+        Return the path of the file of a journal object, or ''.
+        """
+
+        jobject = self.get(object_id)
+
+        if jobject is None:
+            return ''
+
+        return jobject.file_path or ''
+
+    def get_metadata(self, object_id):
+        """
+        Return the metadata of a journal object, or None.
+        """
+
+        jobject = self.get(object_id)
+
+        if jobject is None:
+            return None
+
+        return jobject.metadata
+
+    def invalidate(self, object_id=None):
+        """
+        Drop the object with object_id, or all of them.
+        """
+
+        if object_id is None:
+            object_ids = self._objects.keys()
+
+        else:
+            object_ids = [object_id]
+
+        for object_id in object_ids:
+            jobject = self._objects.pop(object_id, None)
+
+            if jobject is not None:
+                self.__destroy(jobject)
+
+    def __destroy(self, jobject):
+
+        # file_path would fetch the file of an object only used for its
+        # metadata, just to delete it
+        file_path = jobject.get_file_path(fetch=False)
+
+        if file_path is not None and file_path in self._pins:
+            self._doomed.setdefault(file_path, []).append(jobject)
+
+        else:
+            jobject.destroy()
+
+    def __changed_cb(self, sender, object_id=None, **kwargs):
+
+        if object_id in self._objects:
+            self._logger.debug('%s changed in the datastore' % object_id)
+            self.invalidate(object_id)
@@ -0,0 +1,178 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import Queue
+import logging
+import threading
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+
+class DecodeRequest(object):
+    """
+    A request for a decoded image, returned by ImageDecoder.decode.
+    """
+
+    __slots__ = ('_job', 'callback', 'args')
+
+    def __init__(self, job, callback, args):
+
+        self._job = job
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        """
+        Don't call back with the image. The decoding itself is dropped
+        when nobody else asked for the same image.
+        """
+
+        if self in self._job.requests:
+            self._job.requests.remove(self)
+
+        if not self._job.requests:
+            self._job.cancelled = True
+
+
+class _DecodeJob(object):
+
+    __slots__ = ('key', 'thumbnail', 'requests', 'cancelled')
+
+    def __init__(self, key, thumbnail=None):
+
+        self.key = key  # (path, width, height)
+        self.thumbnail = thumbnail
+        self.requests = []
+        self.cancelled = False
+
+
+class ImageDecoder(object):
+    """
+    Decode image files to pixbufs on a few worker threads.
+
+    The finished pixbufs are handed back to the GTK main loop with
+    GLib.idle_add, so the callbacks can touch the widgets. The number of
+    threads bounds the number of images decoded at the same time, and
+    requests for an image that is already queued share its decoding.
+    With a ThumbnailCache, decode_thumbnail reads and writes scaled
+    copies of the images.
+    """
+
+    def __init__(self, workers=2, thumbnails=None, files=None):
+        """
+        files -- object with pin(path) and unpin(path), like a
+          DatastoreCache, told which files are being read
+        """
+
+        self._logger = logging.getLogger('poll-activity.ImageDecoder')
+        self._thumbnails = thumbnails
+        self._files = files
+        self._queue = Queue.Queue()
+        self._workers_count = workers
+        self._workers = []
+        self._jobs = {}  # (path, width, height) -> _DecodeJob
+
+    def decode(self, path, width, height, callback, *args):
+        """
+        Queue the decoding of the image file in path at width x height.
+
+        callback(pixbuf, *args) is called from the main loop, pixbuf is
+        None if the file could not be decoded. Return a DecodeRequest.
+        """
+
+        return self.decode_thumbnail(None, path, width, height, callback,
+                                     *args)
+
+    def decode_thumbnail(self, thumbnail_path, path, width, height,
+                         callback, *args):
+        """
+        Like decode, but load the thumbnail in thumbnail_path instead if
+        it is in the ThumbnailCache, or add it there.
+
+        thumbnail_path -- from ThumbnailCache.get_path, or None
+        """
+
+        if self._thumbnails is None:
+            thumbnail_path = None
+
+        key = (path, width, height)
+        job = self._jobs.get(key)
+
+        if job is None or job.cancelled:
+            job = self._jobs[key] = _DecodeJob(key, thumbnail_path)
+
+            if self._files is not None:
+                # Unpinned by __deliver
+                self._files.pin(path)
+
+            if len(self._workers) < self._workers_count:
+                worker = threading.Thread(target=self.__run)
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+
+            self._queue.put(job)
+
+        request = DecodeRequest(job, callback, args)
+        job.requests.append(request)
+
+        return request
+
+    def __run(self):
+
+        while True:
+            job = self._queue.get()
+
+            if job is None:
+                return
+
+            if job.cancelled:
+                # Forgotten from the main loop, like the decoded ones
+                GLib.idle_add(self.__deliver, job, None)
+                continue
+
+            path, width, height = job.key
+            pixbuf = None
+
+            if job.thumbnail is not None:
+                pixbuf = self._thumbnails.load(job.thumbnail)
+
+            if pixbuf is None:
+                try:
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                        path, width, height)
+
+                except GLib.GError, e:
+                    self._logger.debug('Can not decode %s: %s' % (path, e))
+
+                else:
+                    if job.thumbnail is not None:
+                        self._thumbnails.store(job.thumbnail, pixbuf)
+
+            GLib.idle_add(self.__deliver, job, pixbuf)
+
+    def __deliver(self, job, pixbuf):
+
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+        if not job.cancelled:
+            for request in list(job.requests):
+                request.callback(pixbuf, *request.args)
+
+        if self._files is not None:
+            self._files.unpin(job.key[0])
+
+        return False
@@ -0,0 +1,169 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+
+from collections import deque
+from functools import partial
+from hashlib import sha1
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+# Bytes asked for in every GetImageChunk call
+CHUNK_SIZE = 16 * 1024
+
+# The most GetImageChunk sends at once, whatever it is asked
+MAX_CHUNK_SIZE = 64 * 1024
+
+# Seconds a GetImageChunk call waits for the reply
+CHUNK_TIMEOUT = 20
+
+
+class _Transfer(object):
+
+    __slots__ = ('bus_name', 'blob_hash', 'callback', 'chunks', 'offset',
+                 'loader')
+
+    def __init__(self, bus_name, blob_hash, callback):
+
+        self.bus_name = bus_name
+        self.blob_hash = blob_hash
+        self.callback = callback
+        self.chunks = []
+        self.offset = 0
+        self.loader = None
+
+
+class ImageFetcher(object):
+    """
+    Fetch images from the buddies in chunks with GetImageChunk.
+
+    Every transfer asks for the next chunk once the previous one was
+    decoded, and only a few transfers run at the same time, so big
+    images don't fill the tube. The chunks are fed to a PixbufLoader
+    from idle callbacks, a bit at a time.
+    """
+
+    def __init__(self, blobs, get_object, dbus_interface, transfers=2):
+        """
+        blobs -- BlobStore, where the images are added
+        get_object -- function returning the remote object of a bus name
+        dbus_interface -- string, the interface of GetImageChunk
+        transfers -- the most images fetched at the same time
+        """
+
+        self._logger = logging.getLogger('poll-activity.ImageFetcher')
+        self._blobs = blobs
+        self._get_object = get_object
+        self._dbus_interface = dbus_interface
+        self._transfers_count = transfers
+        self._running = 0
+        self._queue = deque()
+
+    def fetch(self, bus_name, blob_hash, callback):
+        """
+        Fetch the image with blob_hash from bus_name.
+
+        callback(blob_hash, pixbuf) is called when it is in the blob
+        store, pixbuf is None if it could not be fetched.
+        """
+
+        self._queue.append(_Transfer(bus_name, blob_hash, callback))
+        self.__start()
+
+    def __start(self):
+
+        while self._queue and self._running < self._transfers_count:
+            transfer = self._queue.popleft()
+            transfer.loader = GdkPixbuf.PixbufLoader()
+            self._running += 1
+            self.__request_chunk(transfer)
+
+    def __request_chunk(self, transfer):
+
+        self._get_object(transfer.bus_name).GetImageChunk(
+            transfer.blob_hash, transfer.offset, CHUNK_SIZE,
+            dbus_interface=self._dbus_interface, byte_arrays=True,
+            timeout=CHUNK_TIMEOUT,
+            reply_handler=partial(self.__chunk_cb, transfer),
+            error_handler=partial(self.__chunk_error_cb, transfer))
+
+    def __chunk_cb(self, transfer, data):
+
+        GLib.idle_add(self.__decode_chunk, transfer, str(data))
+
+    def __decode_chunk(self, transfer, data):
+
+        transfer.chunks.append(data)
+        transfer.offset += len(data)
+
+        try:
+            if data:
+                transfer.loader.write(data)
+
+        except GLib.GError, e:
+            self.__finish(transfer, None, e)
+            return False
+
+        if len(data) < CHUNK_SIZE:
+            self.__close(transfer)
+
+        else:
+            self.__request_chunk(transfer)
+
+        return False
+
+    def __close(self, transfer):
+
+        data = ''.join(transfer.chunks)
+
+        if sha1(data).hexdigest() != transfer.blob_hash:
+            self.__finish(transfer, None, 'wrong image data')
+            return
+
+        try:
+            transfer.loader.close()
+            pixbuf = transfer.loader.get_pixbuf()
+
+        except GLib.GError, e:
+            self.__finish(transfer, None, e)
+            return
+
+        self._blobs.add(data, pixbuf)
+        self.__finish(transfer, pixbuf)
+
+    def __chunk_error_cb(self, transfer, e):
+
+        self.__finish(transfer, None, e)
+
+    def __finish(self, transfer, pixbuf, error=None):
+
+        if error is not None:
+            self._logger.error('Can not fetch %s from %s: %s' %
+                               (transfer.blob_hash, transfer.bus_name,
+                                error))
+
+            try:
+                transfer.loader.close()
+
+            except GLib.GError:
+                pass
+
+        transfer.loader = None
+        transfer.chunks = []
+        self._running -= 1
+
+        transfer.callback(transfer.blob_hash, pixbuf)
+        self.__start()
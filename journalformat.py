@@ -0,0 +1,479 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Compact binary journal format.
+
+    header   MAGIC, version (B), flags (B)
+    settings view_answer, remember_last_vote, play_vote_sound,
+             use_image (4 x B), image width and height (2 x H)
+    snapshot length (I) and id of the snapshot, since version 2
+    polls    count (I), then a length (I) and a record for every poll
+
+Every poll record has its own table of interned strings, the fields of
+the poll refer to strings by their index in the table. The voter shas
+are kept in the table as 20 raw bytes each. The votes and the vote log
+are packed arrays. The baseline of the vote log comes last, records
+written without it are read with an empty baseline. With FLAG_ZLIB every
+record is compressed on its own, so records can be encoded, and cached,
+one poll at a time.
+
+Integers are little endian.
+"""
+
+import sys
+import json
+import zlib
+import struct
+
+from array import array
+
+MAGIC = 'POLB'
+VERSION = 2
+
+FLAG_ZLIB = 1
+
+_HEADER = struct.Struct('<4sBB')
+_SETTINGS = struct.Struct('<BBBBHH')
+_COUNT = struct.Struct('<I')
+_POLL = struct.Struct('<IIIBIIB')
+
+
+class FormatError(ValueError):
+    """
+    The data is not in the binary journal format.
+    """
+
+
+FORMAT_BINARY = 'binary'
+FORMAT_JSON = 'json'
+FORMAT_PICKLE = 'pickle'
+
+# Enough of the start of a file for sniff()
+SNIFF_SIZE = 16
+
+
+def is_binary(head):
+    """
+    Return True if head, the first bytes of a file, is in this format.
+    """
+
+    return head[:len(MAGIC)] == MAGIC
+
+
+def sniff(head):
+    """
+    Return the format of a journal file from its first bytes.
+
+    FORMAT_BINARY for this format, FORMAT_JSON for the JSON object
+    written by previous versions, FORMAT_PICKLE for the sequence of
+    pickles written by the oldest ones, or None.
+    """
+
+    if is_binary(head):
+        return FORMAT_BINARY
+
+    if head.lstrip()[:1] == '{':
+        return FORMAT_JSON
+
+    # The pickled number of polls, protocol 0 or protocol 2
+    if head[:1] in ('I', 'L') or head[:2] == '\x80\x02':
+        return FORMAT_PICKLE
+
+    return None
+
+
+def write(f, settings, records, compressed):
+    """
+    Write a journal file.
+
+    settings -- dict with the activity settings, as in write_file, and
+      optionally the 'snapshot_id' string
+    records -- list of poll records made by encode_poll
+    compressed -- bool, the records were made with compress=True
+    """
+
+    flags = FLAG_ZLIB if compressed else 0
+    snapshot_id = settings.get('snapshot_id', '')
+
+    f.write(_HEADER.pack(MAGIC, VERSION, flags))
+    f.write(_SETTINGS.pack(
+        settings['view_answer'], settings['remember_last_vote'],
+        settings['play_vote_sound'], settings['use_image'],
+        settings['image_size']['width'], settings['image_size']['height']))
+    f.write(_COUNT.pack(len(snapshot_id)))
+    f.write(snapshot_id)
+
+    f.write(_COUNT.pack(len(records)))
+
+    for record in records:
+        f.write(_COUNT.pack(len(record)))
+        f.write(record)
+
+
+def read(f):
+    """
+    Read a journal file written by write().
+
+    Return the settings dict and the list of polls, as dicts like the
+    ones of Poll.dump with int keys.
+    """
+
+    buf = f.read()
+    magic, version, flags = _HEADER.unpack_from(buf, 0)
+
+    if magic != MAGIC:
+        raise FormatError('Not a binary poll journal')
+
+    if version > VERSION:
+        raise FormatError('Unknown binary journal version %d' % version)
+
+    offset = _HEADER.size
+    view_answer, remember_last_vote, play_vote_sound, use_image, width, \
+        height = _SETTINGS.unpack_from(buf, offset)
+    offset += _SETTINGS.size
+
+    settings = {'view_answer': bool(view_answer),
+                'remember_last_vote': bool(remember_last_vote),
+                'play_vote_sound': bool(play_vote_sound),
+                'use_image': bool(use_image),
+                'image_size': {'width': width, 'height': height},
+                'snapshot_id': ''}
+
+    if version >= 2:
+        length, = _COUNT.unpack_from(buf, offset)
+        offset += _COUNT.size
+        settings['snapshot_id'] = buf[offset:offset + length]
+        offset += length
+
+    count, = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+
+    polls_data = []
+
+    for index in xrange(count):
+        length, = _COUNT.unpack_from(buf, offset)
+        offset += _COUNT.size
+        polls_data.append(decode_poll(buf[offset:offset + length],
+                                      flags & FLAG_ZLIB))
+        offset += length
+
+    return settings, polls_data
+
+
+def write_json(f, settings, polls_data):
+    """
+    Write a journal file in the JSON format of previous versions, that
+    they can read.
+
+    settings -- dict, as for write()
+    polls_data -- list of dicts from Poll.dump
+    """
+
+    data = dict(settings)
+    data['polls_data'] = polls_data
+    json.dump(data, f)
+
+
+def read_json(f):
+    """
+    Read a journal file in the JSON format.
+
+    Return the settings dict, with 'snapshot_id' set to '' if there is
+    none, and the list of polls, as for read().
+    """
+
+    data = json.load(f)
+    polls_data = data.pop('polls_data')
+    data.setdefault('snapshot_id', '')
+
+    for poll_data in polls_data:
+        # json stores the dictionary keys as strings,
+        # convert to int
+        for field in ('options', 'images_ds_objects', 'data'):
+            values = {}
+            for key in poll_data[field]:
+                values[int(key)] = poll_data[field][key]
+            poll_data[field] = values
+
+    return data, polls_data
+
+
+def encode_poll(poll_data, compress=False):
+    """
+    Encode the output of Poll.dump as a poll record.
+    """
+
+    strings = _StringTable()
+
+    options = poll_data['options']
+    choices = range(max(len(options), 5))
+
+    out = [_POLL.pack(
+        strings.add(poll_data['title']), strings.add(poll_data['author']),
+        strings.add(poll_data['question']), poll_data['active'],
+        poll_data['createdate'], poll_data['maxvoters'],
+        poll_data['number_of_options']), chr(len(choices))]
+
+    out.append(_pack('I', [strings.add(options.get(choice, ''))
+                           for choice in choices]))
+    out.append(_pack('I', [int(poll_data['data'].get(choice, 0))
+                           for choice in choices]))
+    out.append(_pack('I', [
+        strings.add(poll_data['images_ds_objects'].get(choice, ''))
+        for choice in choices]))
+
+    votes = poll_data['votes']
+    voters = votes.keys()
+    out.append(_COUNT.pack(len(voters)))
+    out.append(_pack('I', strings.add_all(voters)))
+    out.append(_pack('B', [votes[votersha] for votersha in voters]))
+
+    vote_log = poll_data.get('vote_log') or {
+        'voter_shas': [], 'choices': [], 'voters': [], 'times': []}
+    out.append(_COUNT.pack(len(vote_log['voter_shas'])))
+    out.append(_pack('I', strings.add_all(vote_log['voter_shas'])))
+    out.append(_COUNT.pack(len(vote_log['choices'])))
+    out.append(_pack('B', vote_log['choices']))
+    out.append(_pack('I', vote_log['voters']))
+    out.append(_pack('d', vote_log['times']))
+    baseline = vote_log.get('baseline', [])
+    out.append(_COUNT.pack(len(baseline)))
+    out.append(_pack('I', baseline))
+
+    record = strings.encode() + ''.join(out)
+
+    if compress:
+        record = zlib.compress(record, 1)
+
+    return record
+
+
+def decode_poll(record, compressed=False):
+    """
+    Decode a poll record made by encode_poll.
+    """
+
+    if compressed:
+        record = zlib.decompress(record)
+
+    strings, offset = _StringTable.decode(record)
+
+    title, author, question, active, createdate, maxvoters, \
+        number_of_options = _POLL.unpack_from(record, offset)
+    offset += _POLL.size
+
+    choices = ord(record[offset])
+    offset += 1
+
+    options, offset = _unpack('I', record, offset, choices)
+    data, offset = _unpack('I', record, offset, choices)
+    image_ids, offset = _unpack('I', record, offset, choices)
+
+    count, = _COUNT.unpack_from(record, offset)
+    offset += _COUNT.size
+    voters, offset = _unpack('I', record, offset, count)
+    votes_choices, offset = _unpack('B', record, offset, count)
+
+    count, = _COUNT.unpack_from(record, offset)
+    offset += _COUNT.size
+    log_voters, offset = _unpack('I', record, offset, count)
+
+    count, = _COUNT.unpack_from(record, offset)
+    offset += _COUNT.size
+    log_choices, offset = _unpack('B', record, offset, count)
+    log_voter_indexes, offset = _unpack('I', record, offset, count)
+    log_times, offset = _unpack('d', record, offset, count)
+
+    baseline = []
+    if offset < len(record):
+        count, = _COUNT.unpack_from(record, offset)
+        offset += _COUNT.size
+        baseline, offset = _unpack('I', record, offset, count)
+        baseline = baseline.tolist()
+
+    return {
+        'title': strings[title],
+        'author': strings[author],
+        'active': bool(active),
+        'createdate': createdate,
+        'maxvoters': maxvoters,
+        'question': strings[question],
+        'number_of_options': number_of_options,
+        'options': dict((choice, strings[index])
+                        for choice, index in enumerate(options)),
+        'data': dict(enumerate(data)),
+        'images_ds_objects': dict((choice, strings[index])
+                                  for choice, index in enumerate(image_ids)),
+        'votes': dict(zip([strings[voter] for voter in voters],
+                          votes_choices)),
+        'vote_log': {'voter_shas': [strings[index] for index in log_voters],
+                     'choices': log_choices.tolist(),
+                     'voters': log_voter_indexes.tolist(),
+                     'times': log_times.tolist(),
+                     'baseline': baseline}}
+
+
+def _pack(typecode, values):
+
+    packed = array(typecode, values)
+
+    if sys.byteorder == 'big':
+        packed.byteswap()
+
+    return packed.tostring()
+
+
+def _unpack(typecode, buf, offset, count):
+
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.fromstring(buf[offset:end])
+
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values, end
+
+
+class _StringTable(object):
+    """
+    The interned strings of a poll record.
+
+    Voter shas are kept apart from the other strings, as one block of
+    20 byte digests that is converted in one go. Text strings get even
+    indexes and shas odd ones.
+    """
+
+    def __init__(self):
+
+        self._texts = []
+        self._shas = []
+        self._index = {}
+
+    def add(self, string):
+        """
+        Intern string and return its index.
+        """
+
+        index = self._index.get(string)
+
+        if index is None:
+            index = self.__add_new(string)
+
+        return index
+
+    def add_all(self, strings):
+        """
+        Intern every string in the list and return their indexes.
+        """
+
+        index = self._index
+        seen = set()
+        new = [string for string in strings
+               if string not in index and
+               not (string in seen or seen.add(string))]
+
+        if new:
+            # Usually all voter shas, check them in one go
+            joined = ''.join(new)
+
+            if len(joined) == 40 * len(new) and joined == joined.lower() \
+                    and _is_hex(joined):
+                first = len(self._shas)
+                self._shas.extend(new)
+                index.update(zip(new, xrange(first * 2 + 1,
+                                             (first + len(new)) * 2, 2)))
+
+            else:
+                for string in new:
+                    self.__add_new(string)
+
+        return [index[string] for string in strings]
+
+    def __add_new(self, string):
+
+        key = string
+
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+
+        if len(string) == 40 and string == string.lower() and \
+                _is_hex(string):
+            index = len(self._shas) * 2 + 1
+            self._shas.append(string)
+
+        else:
+            index = len(self._texts) * 2
+            self._texts.append(string)
+
+        self._index[key] = index
+
+        return index
+
+    def encode(self):
+
+        out = [_COUNT.pack(len(self._texts))]
+
+        for string in self._texts:
+            out.append(_COUNT.pack(len(string)))
+            out.append(string)
+
+        out.append(_COUNT.pack(len(self._shas)))
+        out.append(''.join(self._shas).decode('hex'))
+
+        return ''.join(out)
+
+    @staticmethod
+    def decode(buf):
+        """
+        Return the list of strings at the start of buf, by index, and
+        the offset of the data after them.
+        """
+
+        count, = _COUNT.unpack_from(buf, 0)
+        offset = _COUNT.size
+        texts = []
+
+        for index in xrange(count):
+            length, = _COUNT.unpack_from(buf, offset)
+            offset += _COUNT.size
+            texts.append(buf[offset:offset + length])
+            offset += length
+
+        count, = _COUNT.unpack_from(buf, offset)
+        offset += _COUNT.size
+        digests = buf[offset:offset + 20 * count].encode('hex')
+        offset += 20 * count
+
+        shas = [digests[start:start + 40]
+                for start in xrange(0, len(digests), 40)]
+
+        size = max(len(texts), len(shas))
+        strings = [None] * (size * 2)
+        strings[0::2] = texts + [None] * (size - len(texts))
+        strings[1::2] = shas + [None] * (size - len(shas))
+
+        return strings, offset
+
+
+def _is_hex(string):
+
+    try:
+        string.decode('hex')
+
+    except TypeError:
+        return False
+
+    return True
@@ -0,0 +1,115 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+
+from collections import deque
+from functools import partial
+
+
+class _Peer(object):
+
+    __slots__ = ('queue', 'in_flight')
+
+    def __init__(self):
+
+        self.queue = deque()
+        self.in_flight = 0
+
+
+class PeerQueue(object):
+    """
+    Asynchronous calls to the buddies' remote objects.
+
+    The calls to every buddy are queued and only max_in_flight of them
+    wait for a reply at the same time. A call fails after timeout
+    seconds, and the calls still queued for a buddy are dropped then,
+    it has probably left. Nothing blocks the main loop.
+    """
+
+    def __init__(self, get_object, max_in_flight=2, timeout=20):
+        """
+        get_object -- function returning the remote object of a bus name
+        """
+
+        self._logger = logging.getLogger('poll-activity.PeerQueue')
+        self._get_object = get_object
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._peers = {}  # bus name -> _Peer
+
+    def call(self, bus_name, method_name, *args, **kwargs):
+        """
+        Queue the call of method_name on bus_name.
+
+        kwargs are passed to the call, like dbus_interface, but
+        reply_handler, if any, is called with the reply of the call.
+        """
+
+        peer = self._peers.get(bus_name)
+
+        if peer is None:
+            peer = self._peers[bus_name] = _Peer()
+
+        reply_handler = kwargs.pop('reply_handler', None)
+        peer.queue.append((method_name, args, kwargs, reply_handler))
+        self.__send(bus_name, peer)
+
+    def forget(self, bus_name):
+        """
+        Drop the calls queued for bus_name, the replies of the ones
+        already sent are ignored.
+        """
+
+        self._peers.pop(bus_name, None)
+
+    def __send(self, bus_name, peer):
+
+        while peer.queue and peer.in_flight < self._max_in_flight:
+            method_name, args, kwargs, reply_handler = peer.queue.popleft()
+            peer.in_flight += 1
+
+            getattr(self._get_object(bus_name), method_name)(
+                *args, timeout=self._timeout,
+                reply_handler=partial(self.__reply_cb, bus_name, peer,
+                                      reply_handler),
+                error_handler=partial(self.__error_cb, bus_name, peer,
+                                      method_name),
+                **kwargs)
+
+    def __reply_cb(self, bus_name, peer, reply_handler, *reply):
+
+        peer.in_flight -= 1
+
+        if self._peers.get(bus_name) is not peer:
+            return
+
+        if reply_handler is not None:
+            reply_handler(*reply)
+
+        self.__send(bus_name, peer)
+
+    def __error_cb(self, bus_name, peer, method_name, e):
+
+        peer.in_flight -= 1
+        self._logger.error('%s on %s failed: %s' % (method_name, bus_name, e))
+
+        if getattr(e, 'get_dbus_name', lambda: None)() == \
+                'org.freedesktop.DBus.Error.NoReply':
+            self._logger.debug('Dropping %d calls to %s' %
+                               (len(peer.queue), bus_name))
+            peer.queue.clear()
+
+        if self._peers.get(bus_name) is peer:
+            self.__send(bus_name, peer)
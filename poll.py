@@ -27,8 +27,11 @@ import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('GdkPixbuf', '2.0')
 from gi.repository import Gtk
-from gi.repository import GdkPixbuf
+from gi.repository import GObject
 
+import os
+import uuid
+import base64
 import subprocess
 import cPickle
 import json
@@ -62,13 +65,28 @@ from Widgets import PollCanvas      # Participate in a poll.
 
 from PollSession import PollSession
 from PollSession import Poll
+from PollSession import PollStore
+from votelog import VoteLog
+import votejournal
+from autosave import AutoSave
 import emptypanel
+import journalformat
+from imagedecoder import ImageDecoder
+from dscache import DatastoreCache
+from thumbcache import ThumbnailCache
 from graphics import CHART_TYPE_PIE, CHART_TYPE_VERTICAL_BARS
 
 SERVICE = "org.worldwideworkshop.olpc.PollBuilder"
 IFACE = SERVICE
 PATH = "/org/worldwideworkshop/olpc/PollBuilder"
 
+# Seconds between a change and its automatic save
+AUTOSAVE_INTERVAL = 30
+
+# The format of the saved journal entries. journalformat.FORMAT_JSON
+# saves entries that previous versions of the activity can read.
+JOURNAL_FORMAT = journalformat.FORMAT_BINARY
+
 
 class PollBuilder(activity.Activity):
     """
@@ -90,7 +108,7 @@ class PollBuilder(activity.Activity):
         self._logger = logging.getLogger('poll-activity')
         self._logger.debug('Starting Poll activity')
 
-        self._polls = set()
+        self._polls = PollStore()
         self.current_vote = None
 
         # This property allows result viewing while voting
@@ -110,6 +128,28 @@ class PollBuilder(activity.Activity):
         # This property has the image size
         self._image_size = {'height': 100, 'width': 100}
 
+        # Scaled copies of the option images, kept between sessions
+        self.thumbnail_cache = ThumbnailCache(os.path.join(
+            self.get_activity_root(), 'data', 'thumbnails'))
+
+        # The journal objects of the option images
+        self.datastore_cache = DatastoreCache()
+
+        # Decodes the option images in the background
+        self.image_decoder = ImageDecoder(thumbnails=self.thumbnail_cache,
+                                          files=self.datastore_cache)
+
+        # Votes and poll changes since the last write_file
+        self._snapshot_id = None
+        self.vote_journal = votejournal.VoteJournal(os.path.join(
+            self.get_activity_root(), 'instance',
+            'votes-%s.log' % self.get_id()))
+
+        # Saves the changes in the background
+        self.autosave = AutoSave(self, os.path.join(
+            self.get_activity_root(), 'instance',
+            'autosave-%s' % self.get_id()), AUTOSAVE_INTERVAL)
+
         # the active poll
         self._poll = None
 
@@ -150,17 +190,16 @@ class PollBuilder(activity.Activity):
     def __create_pixbufs(self, images_ds_object_id):
         """
         Crea las imágenes de la encuesta, al leer desde el journal.
+
+        The images are not decoded here, they are marked as pending
+        (None) and Poll.load_image decodes them when they are shown.
         """
 
         pixbufs = {}
 
         for index, ds_object_id in images_ds_object_id.iteritems():
             if not ds_object_id == '':
-                image_file_path = datastore.get(ds_object_id).file_path
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(
-                    image_file_path, self._image_size['height'],
-                    self._image_size['width'])
-                pixbufs[int(index)] = pixbuf
+                pixbufs[int(index)] = None
 
             else:
                 pixbufs[int(index)] = ''
@@ -170,6 +209,9 @@ class PollBuilder(activity.Activity):
     def __get_images_ds_objects(self, images_ds_object_id):
         """
         Obtiene las imagenes almacenadas en el jornal.
+
+        Only the ids are set, Poll.get_image_file_path asks the
+        datastore cache for the file when it is needed.
         """
 
         images_ds_objects = {}
@@ -179,53 +221,58 @@ class PollBuilder(activity.Activity):
 
             if not ds_object_id == '':
                 images_ds_objects[int(index)]['id'] = ds_object_id
-                images_ds_objects[int(index)]['file_path'] = \
-                    datastore.get(ds_object_id).file_path
 
         return images_ds_objects
 
+    def get_ds_object_file_path(self, ds_object_id):
+        """
+        Return the path of the file of a journal object.
+        """
+
+        return self.datastore_cache.get_file_path(ds_object_id)
+
+    def get_thumbnail_path(self, ds_object_id, width, height):
+        """
+        Return the path of the thumbnail of a journal object in the
+        thumbnail cache, or None if the object is not in the journal.
+        """
+
+        metadata = self.datastore_cache.get_metadata(ds_object_id)
+
+        if metadata is None:
+            return None
+
+        return self.thumbnail_cache.get_path(
+            ds_object_id, metadata.get('timestamp', ''), width, height)
+
     def read_file(self, file_path):
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-
-                self._view_answer = data['view_answer']
-                self._remember_last_vote = data['remember_last_vote']
-                self._play_vote_sound = data['play_vote_sound']
-                self._use_image = data['use_image']
-                self._image_size = data['image_size']
-                self._polls = set()
-                for poll_data in data['polls_data']:
-                    # json stores the dictionary keys as strings,
-                    # convert to int
-                    options = {}
-                    for key in poll_data['options']:
-                        options[int(key)] = poll_data['options'][key]
-
-                    images_ds_objects = {}
-                    for key in poll_data['images_ds_objects']:
-                        images_ds_objects[int(key)] = \
-                            poll_data['images_ds_objects'][key]
-
-                    data = {}
-                    for key in poll_data['data']:
-                        data[int(key)] = poll_data['data'][key]
-
-                    images = self.__create_pixbufs(images_ds_objects)
-                    images_ds_object = self.__get_images_ds_objects(
-                        images_ds_objects)
-                    self._polls.add(Poll(
-                        self, poll_data['title'], poll_data['author'],
-                        poll_data['active'],
-                        date.fromordinal(poll_data['createdate']),
-                        poll_data['maxvoters'], poll_data['question'],
-                        poll_data['number_of_options'],
-                        options, data, poll_data['votes'],
-                        images, images_ds_object))
-        except:
-            # if can't read json, try read with the old format
+        with open(file_path, 'rb') as f:
+            head = f.read(journalformat.SNIFF_SIZE)
+
+        journal_format = journalformat.sniff(head)
+        self._logger.debug('Reading %s file %s' %
+                           (journal_format, file_path))
+
+        if journal_format == journalformat.FORMAT_BINARY:
+            self.__read_binary_file(file_path)
+
+        elif journal_format == journalformat.FORMAT_JSON:
+            self.__read_json_file(file_path)
+
+        elif journal_format == journalformat.FORMAT_PICKLE:
             self._old_read_file(file_path)
 
+        else:
+            raise journalformat.FormatError(
+                'Unknown journal file format %r' % head)
+
+        self.__replay_vote_journal()
+
+        if journal_format != JOURNAL_FORMAT:
+            # Save the entry again once, so it is read in the
+            # format it is written in next time
+            GObject.idle_add(self.__migrate_journal_cb)
+
         # if there are polls loaded, show the selection screen
         # if not, show the creation screen
         if self._polls:
@@ -236,6 +283,107 @@ class PollBuilder(activity.Activity):
 
         self.get_toolbar_box().update_configs()
 
+    def __migrate_journal_cb(self):
+
+        self._logger.debug('Saving the journal entry in the current format')
+        self.save()
+
+        return False
+
+    def __read_binary_file(self, file_path):
+
+        with open(file_path, 'rb') as f:
+            settings, polls_data = journalformat.read(f)
+
+        self.__set_settings(settings)
+        self._snapshot_id = settings['snapshot_id']
+        self._polls = PollStore()
+
+        for poll_data in polls_data:
+            self._polls.add(self.__load_poll(poll_data))
+
+    def __replay_vote_journal(self):
+        """
+        Apply the changes logged after the snapshot that was just read,
+        they were not saved in the journal entry because of a crash.
+        """
+
+        events = self.vote_journal.replay(self._snapshot_id)
+
+        for event in events:
+            if event[0] == votejournal.EVENT_VOTES:
+                author, title, votes = event[1:]
+                for poll in self._polls.find(author, title):
+                    poll.register_votes([tuple(vote) for vote in votes])
+
+            elif event[0] == votejournal.EVENT_POLL:
+                poll = self.__load_poll(journalformat.decode_poll(
+                    base64.b64decode(event[1]), True))
+                # The events of older versions have no old identity
+                author, title = event[2:4] or [poll.author, poll.title]
+                for old_poll in self._polls.find(author, title):
+                    self._polls.remove(old_poll)
+                self._polls.add(poll)
+
+            elif event[0] == votejournal.EVENT_DELETE:
+                for poll in self._polls.find(event[1], event[2]):
+                    self._polls.remove(poll)
+
+        if events:
+            self.autosave.changed()
+
+    def __read_json_file(self, file_path):
+
+        with open(file_path, 'r') as f:
+            settings, polls_data = journalformat.read_json(f)
+
+        self.__set_settings(settings)
+        self._snapshot_id = settings['snapshot_id']
+        self._polls = PollStore()
+
+        for poll_data in polls_data:
+            self._polls.add(self.__load_poll(poll_data))
+
+    def __set_settings(self, settings):
+
+        self._view_answer = settings['view_answer']
+        self._remember_last_vote = settings['remember_last_vote']
+        self._play_vote_sound = settings['play_vote_sound']
+        self._use_image = settings['use_image']
+        self._image_size = settings['image_size']
+
+    def get_settings(self):
+
+        return {'view_answer': self._view_answer,
+                'remember_last_vote': self._remember_last_vote,
+                'play_vote_sound': self._play_vote_sound,
+                'use_image': self._use_image,
+                'image_size': dict(self._image_size)}
+
+    def __load_poll(self, poll_data):
+        """
+        Create a Poll from the output of Poll.dump, with int keys.
+        """
+
+        vote_log = None
+        if poll_data.get('vote_log'):
+            vote_log = VoteLog.load(poll_data['vote_log'])
+
+        images = self.__create_pixbufs(poll_data['images_ds_objects'])
+        images_ds_object = self.__get_images_ds_objects(
+            poll_data['images_ds_objects'])
+        poll = Poll(
+            self, poll_data['title'], poll_data['author'],
+            poll_data['active'],
+            date.fromordinal(poll_data['createdate']),
+            poll_data['maxvoters'], poll_data['question'],
+            poll_data['number_of_options'],
+            poll_data['options'], poll_data['data'], poll_data['votes'],
+            images, images_ds_object, vote_log)
+        poll.check_vote_count()
+
+        return poll
+
     def _old_read_file(self, file_path):
         """
         This method use pickle to read files saved by old versions of the
@@ -246,7 +394,7 @@ class PollBuilder(activity.Activity):
             'Reading OLD FORMAT file from datastore via Journal: %s' %
             file_path)
 
-        self._polls = set()
+        self._polls = PollStore()
 
         f = open(file_path, 'r')
         num_polls = cPickle.load(f)
@@ -278,6 +426,7 @@ class PollBuilder(activity.Activity):
                         date.fromordinal(int(createdate_i)),
                         maxvoters, question, number_of_options, options,
                         data, votes, images, images_ds_object)
+            poll.check_vote_count()
 
             self._polls.add(poll)
 
@@ -285,6 +434,13 @@ class PollBuilder(activity.Activity):
 
         self.set_canvas(SelectCanvas(self))
 
+    def can_close(self):
+
+        # The last save is done by Activity.close
+        self.autosave.close()
+
+        return True
+
     def write_file(self, file_path):
         """
         Implement writing to the journal
@@ -293,19 +449,79 @@ class PollBuilder(activity.Activity):
         which provides the file_path.
         """
 
-        polls_data = []
-        for poll in self._polls:
-            polls_data.append(poll.dump())
-        data = {
-            'view_answer': self._view_answer,
-            'remember_last_vote': self._remember_last_vote,
-            'play_vote_sound': self._play_vote_sound,
-            'use_image': self._use_image,
-            'image_size': self._image_size,
-            'polls_data': polls_data}
+        self.autosave.cancel()
+        snapshot_id = None
+
+        if JOURNAL_FORMAT == journalformat.FORMAT_BINARY:
+            # Written in the background by the autosave, if nothing
+            # changed
+            snapshot_id = self.autosave.use_snapshot(file_path)
+
+        if snapshot_id is None:
+            settings = self.get_settings()
+            settings['snapshot_id'] = snapshot_id = uuid.uuid4().hex
+
+            if JOURNAL_FORMAT == journalformat.FORMAT_JSON:
+                with open(file_path, 'w') as f:
+                    journalformat.write_json(
+                        f, settings, [poll.dump() for poll in self._polls])
+
+            else:
+                records = []
+                for poll in self._polls:
+                    records.append(poll.dump_binary())
+
+                with open(file_path, 'wb') as f:
+                    journalformat.write(f, settings, records, True)
+
+        # The snapshot has all the logged changes now
+        self.vote_journal.compact(snapshot_id)
+        self._snapshot_id = snapshot_id
+
+    def add_poll(self, poll):
+        """
+        Store a poll created or edited here, or new from the mesh.
+        """
+
+        self._polls.add(poll)
+        self.__log_poll(poll)
+        self.autosave.changed()
+
+    def update_poll(self, poll, old_poll=None):
+        """
+        Store a poll updated from the mesh, in place of old_poll if it
+        is given, and show the changes.
+
+        The votes from the mesh are logged on their own and the rest is
+        in the next autosave, so the whole poll is only logged when the
+        journal does not know it by its author and title yet.
+        """
+
+        new = old_poll is None and poll not in self._polls
+
+        if old_poll is not None and old_poll is not poll:
+            self._polls.discard(old_poll)
+
+            if self._poll is old_poll:
+                self._poll = poll
+
+        self._polls.add(poll)
+
+        if new or poll.journal_identity != (poll.author, poll.title):
+            self.__log_poll(poll)
+
+        self.autosave.changed()
+
+        if self._poll is poll and type(self.get_canvas()) is PollCanvas:
+            self.set_canvas(PollCanvas(self._poll, self.current_vote,
+                                       self._view_answer,
+                                       self._chart_type_selected))
 
-        with open(file_path, 'w') as f:
-            f.write(json.dumps(data))
+    def __log_poll(self, poll):
+
+        # An edited poll replaces the one with its old title on replay
+        self.vote_journal.log_poll(poll, *poll.journal_identity)
+        poll.journal_identity = (poll.author, poll.title)
 
     def get_alert(self, title, text):
         """
@@ -336,6 +552,9 @@ class PollBuilder(activity.Activity):
         toolbarbox.export_data_bt.set_sensitive(enable_charts)
         toolbarbox.export_image_bt.set_sensitive(enable_charts)
 
+        if type(self.get_canvas()) is PollCanvas:
+            self.get_canvas().cancel_image_loading()
+
         activity.Activity.set_canvas(self, widget)
 
     def _poll_canvas(self):
@@ -376,10 +595,12 @@ class PollBuilder(activity.Activity):
                 self._logger.debug('Strange, which button was clicked?')
                 return
 
-            for poll in self._polls:
-                if poll.sha == sha:
-                    self._polls.remove(poll)
-                    break
+            poll = self._polls.get(sha)
+
+            if poll is not None:
+                self._polls.remove(poll)
+                self.vote_journal.log_delete(*poll.journal_identity)
+                self.autosave.changed()
 
             self.set_canvas(SelectCanvas(self))
 
@@ -410,6 +631,10 @@ class PollBuilder(activity.Activity):
 
         try:
             self._poll.register_vote(self.current_vote, self.nick_sha1)
+            self.vote_journal.log_votes(
+                self._poll.author, self._poll.title,
+                [(self.current_vote, self.nick_sha1)])
+            self.autosave.changed()
 
         except OverflowError:
             self._logger.debug('Local vote failed: '
@@ -464,20 +689,21 @@ class PollBuilder(activity.Activity):
         sha -- string
         """
 
-        for poll in self._polls:
-            if poll.sha == sha:
-                self._poll = poll
-                break
+        poll = self._polls.get(sha)
+
+        if poll is not None:
+            self._poll = poll
 
     def get_my_polls(self):
         """
         Return list of Polls for all polls I created.
         """
 
-        return [poll for poll in self._polls if poll.author == self.nick]
+        return self._polls.by_author(self.nick)
 
     def set_view_answer(self, view_answer):
         self._view_answer = view_answer
+        self.autosave.changed()
         if type(self.get_canvas()) is PollCanvas and self._poll.active:
             poll_canvas = self.get_canvas()
             poll_canvas.set_view_answer(view_answer)
@@ -487,6 +713,7 @@ class PollBuilder(activity.Activity):
 
     def set_use_image(self, use_image):
         self._use_image = use_image
+        self.autosave.changed()
         if type(self.get_canvas()) is NewPollCanvas:
             new_poll_canvas = self.get_canvas()
             new_poll_canvas.set_image_widgets_visible(use_image)
@@ -496,6 +723,7 @@ class PollBuilder(activity.Activity):
 
     def set_remember_last_vote(self, remember_last_vote):
         self._remember_last_vote = remember_last_vote
+        self.autosave.changed()
         if type(self.get_canvas()) is PollCanvas:
             if self._remember_last_vote:
                 self.current_vote = self._poll.last_vote
@@ -627,30 +855,56 @@ class PollBuilder(activity.Activity):
           sha1 of the voter nick
         """
 
-        for poll in self._polls:
-            if poll.author == author and poll.title == title:
-                try:
-                    poll.register_vote(choice, votersha)
-                    self.get_alert(_('Vote'),
-                                   _('Somebody voted on %s') % title)
-
-                    if self._poll == poll and \
-                            type(self.get_canvas()) is PollCanvas:
-                        self.set_canvas(PollCanvas(self._poll,
-                                                   self.current_vote,
-                                                   self._view_answer,
-                                                   self._chart_type_selected))
-
-                except OverflowError:
-                    self._logger.debug(
-                        'Ignored mesh vote %u from %s:'
-                        ' poll reached maximum votes.',
-                        choice, votersha)
-
-                except ValueError:
-                    self._logger.debug(
-                        'Ignored mesh vote %u from %s: poll closed.',
-                        choice, votersha)
+        self.vote_on_poll_batch(author, title, [(choice, votersha)])
+
+    def vote_on_poll_batch(self, author, title, votes):
+        """
+        Register many votes on a poll from the mesh.
+
+        author -- string
+        title -- string
+        votes -- list of (choice, votersha) tuples
+
+        The canvas is refreshed and the alert shown once for the whole
+        batch. Return the list of rejected votes.
+        """
+
+        rejected = []
+        accepted = 0
+
+        for poll in self._polls.find(author, title):
+            poll_rejected = poll.register_votes(votes)
+            accepted += len(votes) - len(poll_rejected)
+            rejected.extend(poll_rejected)
+
+            for choice, votersha in poll_rejected:
+                self._logger.debug(
+                    'Ignored mesh vote %u from %s: poll closed, '
+                    'full or invalid choice.', choice, votersha)
+
+        if accepted:
+            # Replaying the batch rejects the same votes again
+            self.vote_journal.log_votes(author, title, votes)
+            self.autosave.changed()
+
+            if accepted == 1:
+                self.get_alert(_('Vote'),
+                               _('Somebody voted on %s') % title)
+
+            else:
+                self.get_alert(_('Vote'),
+                               _('%(count)d votes on %(title)s') %
+                               {'count': accepted, 'title': title})
+
+            if self._poll is not None and self._poll.author == author and \
+                    self._poll.title == title and \
+                    type(self.get_canvas()) is PollCanvas:
+                self.set_canvas(PollCanvas(self._poll,
+                                           self.current_vote,
+                                           self._view_answer,
+                                           self._chart_type_selected))
+
+        return rejected
 
     # COLABORATION >>
 
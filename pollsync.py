@@ -0,0 +1,219 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Delta synchronization of polls between buddies.
+
+The version of a poll on the mesh is the number of votes in the vote
+log of its author. A buddy that has the poll at some version only needs
+the fields that changed since, and the votes logged after that version.
+An update is (base, position, fields, votes, images): the changes from
+version base to version position, or everything when base is FULL.
+"""
+
+import zlib
+import struct
+
+from datetime import date
+
+import dbus
+
+import journalformat
+
+# Names of the features in the Features signal
+FEATURE_DELTA = 'delta'
+# Images in updates can be blobstore references, see GetImageChunk
+FEATURE_IMAGE_REFS = 'image-refs'
+# Votes are sent with VoteBatch instead of Vote
+FEATURE_VOTE_BATCH = 'vote-batch'
+# Whole polls are sent as compressed records, see pack_poll. The number
+# changes with the format of the record.
+FEATURE_PACKED = 'packed-poll-1'
+
+FEATURES = [FEATURE_DELTA, FEATURE_IMAGE_REFS, FEATURE_VOTE_BATCH,
+            FEATURE_PACKED]
+
+# base of an update with the whole poll
+FULL = 0xffffffff
+
+# The fields sent in updates. The author, and the title the buddy was
+# last sent, name the poll: a renamed poll comes with its new title here.
+FIELDS = {
+    'title': str,
+    'active': bool,
+    'createdate': date.fromordinal,
+    'maxvoters': int,
+    'question': str,
+    'number_of_options': int,
+    'options': lambda options: dict((int(choice), str(text))
+                                    for choice, text in options.items()),
+    'data': lambda data: dict((int(choice), int(count))
+                              for choice, count in data.items())}
+
+
+def get_state(poll):
+    """
+    Return what a buddy knows of poll once it is sent an update:
+    (position, fields, image stamps).
+    """
+
+    return len(poll.vote_log), get_fields(poll), get_image_stamps(poll)
+
+
+def get_fields(poll):
+
+    return {'title': str(poll.title),
+            'active': bool(poll.active),
+            'createdate': poll.createdate.toordinal(),
+            'maxvoters': int(poll.maxvoters),
+            'question': str(poll.question),
+            'number_of_options': int(poll.number_of_options),
+            'options': poll.options.to_dict(),
+            'data': poll.data.to_dict()}
+
+
+def get_title(state):
+    """
+    Return the title of the poll a buddy was sent at state, the one it
+    knows the poll by until it gets the next update.
+    """
+
+    return state[1]['title']
+
+
+def get_image_stamps(poll):
+    """
+    Return something for every image that changes with the image.
+    """
+
+    size = (poll.activity._image_size['width'],
+            poll.activity._image_size['height'])
+
+    return dict((choice, (poll.images_ds_objects.get_id(choice), size))
+                for choice in poll.images)
+
+
+def make_update(poll, states):
+    """
+    Return the update for the buddies that were sent poll at states,
+    and the state they have after it.
+
+    states -- list of states from get_state, None for a buddy that was
+      never sent the poll
+    """
+
+    state = get_state(poll)
+    position, fields, stamps = state
+
+    if not states or None in states:
+        votes = poll.votes.items()
+        return (FULL, position, fields, votes, poll.get_images_buf()), state
+
+    base = min(old_state[0] for old_state in states)
+
+    changed_fields = {}
+    for name, value in fields.iteritems():
+        for old_state in states:
+            if old_state[1].get(name) != value:
+                changed_fields[name] = value
+                break
+
+    votes = []
+    for index in xrange(base, position):
+        choice, votersha, timestamp = poll.vote_log[index]
+        votes.append((votersha, choice))
+
+    images = {}
+    changed_images = [choice for choice, stamp in stamps.iteritems()
+                      if any(old_state[2].get(choice) != stamp
+                             for old_state in states)]
+
+    if changed_images:
+        images_buf = poll.get_images_buf()
+
+        for choice in changed_images:
+            images[choice] = images_buf[choice]
+
+    return (base, position, changed_fields, votes, images), state
+
+
+def to_dbus(update):
+    """
+    Return the update as the D-Bus arguments of PollDelta and SyncPoll
+    after the author and title.
+    """
+
+    base, position, fields, votes, images = update
+
+    dbus_fields = dbus.Dictionary(signature='sv')
+    for name, value in fields.iteritems():
+        if name in ('options', 'data'):
+            value = dbus.Dictionary(
+                value, signature='us' if name == 'options' else 'uu')
+
+        dbus_fields[name] = value
+
+    return (base, position, dbus_fields,
+            dbus.Array([dbus.Struct(vote, signature='su')
+                        for vote in votes], signature='(su)'),
+            dbus.Dictionary(images, signature='us'))
+
+
+def pack_poll(poll):
+    """
+    Return the poll as a zlib compressed journalformat record, without
+    its vote log, journal objects and images.
+    """
+
+    poll_data = poll.dump()
+    poll_data['vote_log'] = None
+    poll_data['images_ds_objects'] = {}
+
+    return zlib.compress(journalformat.encode_poll(poll_data), 9)
+
+
+def unpack_poll(record):
+    """
+    Return (author, title, fields, votes) of a record from pack_poll,
+    votes is a list of (votersha, choice). Raise ValueError if the
+    record can not be decoded.
+    """
+
+    try:
+        poll_data = journalformat.decode_poll(record, True)
+
+    except (zlib.error, struct.error, IndexError, ValueError), e:
+        raise ValueError('Bad poll record: %s' % e)
+
+    fields = dict((name, poll_data[name]) for name in FIELDS)
+
+    return (poll_data['author'], poll_data['title'], fields,
+            poll_data['votes'].items())
+
+
+def read_fields(dbus_fields):
+    """
+    Return the fields of an update received from D-Bus as builtin
+    types, ignoring the ones this version does not know.
+    """
+
+    fields = {}
+
+    for name, value in dbus_fields.items():
+        name = str(name)
+
+        if name in FIELDS:
+            fields[name] = FIELDS[name](value)
+
+    return fields
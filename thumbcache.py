@@ -0,0 +1,159 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import logging
+import threading
+
+from hashlib import sha1
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+
+class ThumbnailCache(object):
+    """
+    Scaled copies of the option images, as PNG files in a directory.
+
+    A thumbnail is named after the sha1 of the journal object id, its
+    timestamp and the size, so a changed object gets new thumbnails.
+    When the files take more than max_size bytes the least recently
+    used ones are removed. load and store can be called from the
+    ImageDecoder threads.
+    """
+
+    def __init__(self, path, max_size=16 * 1024 * 1024):
+
+        self._logger = logging.getLogger('poll-activity.ThumbnailCache')
+        self._path = path
+        self._max_size = max_size
+        self._size = None  # bytes, counted on the first store
+        self._lock = threading.Lock()
+
+    def get_path(self, object_id, timestamp, width, height):
+        """
+        Return the path of the thumbnail, that may not exist yet.
+        """
+
+        key = '%s\0%s\0%d\0%d' % (object_id, timestamp, width, height)
+
+        return os.path.join(self._path, sha1(key).hexdigest() + '.png')
+
+    def read(self, path):
+        """
+        Return the PNG data of the thumbnail in path, or None.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            os.utime(path, None)
+
+        except (IOError, OSError), e:
+            self._logger.debug('Can not read %s: %s' % (path, e))
+            return None
+
+        return data
+
+    def load(self, path):
+        """
+        Return the thumbnail in path as a pixbuf, or None.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            os.utime(path, None)
+
+        except (GLib.GError, OSError), e:
+            self._logger.debug('Can not load %s: %s' % (path, e))
+            return None
+
+        return pixbuf
+
+    def store(self, path, pixbuf):
+        """
+        Save pixbuf as the thumbnail in path.
+        """
+
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+
+        try:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path)
+
+            pixbuf.savev(temp_path, 'png', [], [])
+            os.rename(temp_path, path)
+            size = os.path.getsize(path)
+
+        except (GLib.GError, OSError), e:
+            self._logger.debug('Can not save %s: %s' % (path, e))
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for name, size, mtime in self.__list())
+
+            else:
+                self._size += size
+
+            if self._size > self._max_size:
+                self.__evict(os.path.basename(path))
+
+    def __list(self):
+
+        files = []
+
+        for name in os.listdir(self._path):
+            try:
+                stat = os.stat(os.path.join(self._path, name))
+
+            except OSError:
+                continue
+
+            files.append((name, stat.st_size, stat.st_mtime))
+
+        return files
+
+    def __evict(self, keep):
+        """
+        Remove the least recently used thumbnails but keep, down to
+        three quarters of max_size.
+        """
+
+        files = sorted(self.__list(), key=lambda item: item[2])
+        self._size = sum(size for name, size, mtime in files)
+
+        for name, size, mtime in files:
+            if self._size <= self._max_size * 3 / 4:
+                break
+
+            if name == keep:
+                continue
+
+            try:
+                os.remove(os.path.join(self._path, name))
+
+            except OSError:
+                continue
+
+            self._size -= size
+
+        self._logger.debug('Thumbnails evicted, %d bytes left' % self._size)
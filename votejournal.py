@@ -0,0 +1,257 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Write-ahead log of the changes made since the last journal snapshot.
+
+The log is a text file with one JSON list per line:
+
+    ["s", snapshot_id]               a snapshot was written
+    ["v", author, title, votes]      votes, a list of [choice, votersha]
+    ["p", record, author, title]     a poll was saved, the base64 of
+                                     its compressed journalformat record,
+                                     in place of the poll author and
+                                     title named before it was edited
+    ["d", author, title]             a poll was deleted
+
+When the activity is resumed, the lines after the header of the snapshot
+that was read are replayed. A line cut short by a crash is ignored.
+"""
+
+import os
+import json
+import base64
+import logging
+
+from gi.repository import GObject
+
+EVENT_SNAPSHOT = 's'
+EVENT_VOTES = 'v'
+EVENT_POLL = 'p'
+EVENT_DELETE = 'd'
+
+
+class VoteJournal(object):
+    """
+    Append-only log of votes and poll changes.
+
+    The events are kept in memory and written, then fsynced, once per
+    main loop iteration, so a burst of votes costs one fsync.
+    compact() drops the events that the journal entry already has.
+    """
+
+    def __init__(self, path):
+
+        self._logger = logging.getLogger('poll-activity.VoteJournal')
+        self._path = path
+        self._file = None
+        self._pending = []
+        self._flush_id = None
+        # The snapshot the events in the log apply to
+        self._snapshot_id = None
+
+    def log_votes(self, author, title, votes):
+        """
+        votes -- list of (choice, votersha) tuples
+        """
+
+        self.__append([EVENT_VOTES, author, title,
+                       [[choice, votersha] for choice, votersha in votes]])
+
+    def log_poll(self, poll, author, title):
+        """
+        author, title -- the poll replaced by poll, that may have been
+          renamed since
+        """
+
+        self.__append([EVENT_POLL, base64.b64encode(poll.dump_binary()),
+                       author, title])
+
+    def log_delete(self, author, title):
+
+        self.__append([EVENT_DELETE, author, title])
+
+    def replay(self, snapshot_id):
+        """
+        Return the events logged since snapshot_id was written, as
+        lists like the lines of the file, with utf-8 strings.
+
+        The log is started again if it has no header for snapshot_id,
+        its events belong to another snapshot.
+        """
+
+        self.flush()
+        events = None
+
+        for event in self.__read():
+            if events is not None and event[0] != EVENT_SNAPSHOT:
+                events.append(event)
+
+            elif event[0] == EVENT_SNAPSHOT and event[1] == snapshot_id:
+                events = []
+
+        self._snapshot_id = snapshot_id
+
+        if events is None:
+            self.__rewrite([])
+            return []
+
+        self._logger.debug('Replaying %d events after snapshot %s' %
+                           (len(events), snapshot_id))
+
+        return events
+
+    def compact(self, snapshot_id):
+        """
+        Record that a snapshot with every change so far was written.
+
+        Only the events since the previous snapshot are kept, in case
+        the datastore never gets the new one.
+        """
+
+        self.flush()
+        kept = []
+
+        for event in self.__read():
+            if event[0] == EVENT_SNAPSHOT and \
+                    event[1] == self._snapshot_id:
+                kept = []
+
+            kept.append(event)
+
+        kept.append([EVENT_SNAPSHOT, snapshot_id])
+        self.__rewrite(kept)
+        self._snapshot_id = snapshot_id
+
+    def flush(self):
+        """
+        Write the pending events and fsync the log.
+        """
+
+        if self._flush_id is not None:
+            GObject.source_remove(self._flush_id)
+            self._flush_id = None
+
+        if not self._pending:
+            return
+
+        try:
+            if self._file is None:
+                self.__open()
+
+            self._file.write(''.join(self.__format(event)
+                                     for event in self._pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+        except (IOError, OSError), e:
+            self._logger.error('Can not write %s: %s' % (self._path, e))
+
+        self._pending = []
+
+    def close(self):
+
+        self.flush()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __open(self):
+
+        size = 0
+        if os.path.exists(self._path):
+            size = os.path.getsize(self._path)
+
+        self._file = open(self._path, 'a+')
+
+        if not size:
+            self._pending.insert(0, [EVENT_SNAPSHOT, self._snapshot_id])
+
+        else:
+            self._file.seek(size - 1)
+
+            if self._file.read(1) != '\n':
+                # The last line was cut short, don't append to it
+                self._file.seek(0, os.SEEK_END)
+                self._file.write('\n')
+
+    def __append(self, event):
+
+        self._pending.append(event)
+
+        if self._flush_id is None:
+            self._flush_id = GObject.idle_add(self.__flush_cb)
+
+    def __flush_cb(self):
+
+        self._flush_id = None
+        self.flush()
+
+        return False
+
+    def __format(self, event):
+
+        return json.dumps(event, separators=(',', ':')) + '\n'
+
+    def __read(self):
+
+        if not os.path.exists(self._path):
+            return []
+
+        events = []
+
+        with open(self._path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+
+                except ValueError:
+                    self._logger.debug('Skipping a broken line of %s' %
+                                       self._path)
+                    continue
+
+                events.append(_to_str(event))
+
+        return events
+
+    def __rewrite(self, events):
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        temp_path = self._path + '.tmp'
+
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(''.join(self.__format(event) for event in events))
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(temp_path, self._path)
+
+        except (IOError, OSError), e:
+            self._logger.error('Can not write %s: %s' % (self._path, e))
+
+
+def _to_str(value):
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+
+    return value
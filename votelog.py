@@ -0,0 +1,201 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class VoteLog(object):
+    """
+    Append-only log of every vote cast on one poll.
+
+    Poll.votes only keeps the last choice of every voter, the log keeps
+    all of them. Votes are stored in three array columns: the choice,
+    the index of the voter in a table of interned voter shas, and the
+    time of the vote. Times never go backwards, so time windows are
+    found with a binary search.
+
+    The votes cast before the log was kept, on polls from old journal
+    entries or from buddies that don't send it, are only known as a
+    number of votes for every choice, the baseline.
+    """
+
+    __slots__ = ('choices', 'voters', 'times', 'baseline', '_voter_shas',
+                 '_voter_index')
+
+    def __init__(self):
+
+        self.choices = array('B')
+        self.voters = array('I')
+        self.times = array('d')
+        self.baseline = array('I')
+
+        self._voter_shas = []
+        # Built on the first vote, most polls loaded never get one
+        self._voter_index = None
+
+    def __len__(self):
+        return len(self.choices)
+
+    def __iter__(self):
+        """
+        Iterate over the (choice, votersha, timestamp) of every vote.
+        """
+
+        for position in xrange(len(self.choices)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        return (self.choices[position],
+                self._voter_shas[self.voters[position]],
+                self.times[position])
+
+    def append(self, choice, votersha, timestamp=None):
+        """
+        Add a vote at the end of the log.
+
+        choice -- integer 0-4
+        votersha -- string, sha1 of the voter nick
+        timestamp -- float, defaults to now
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.times and timestamp < self.times[-1]:
+            timestamp = self.times[-1]
+
+        self.choices.append(choice)
+        self.voters.append(self.__intern_voter(votersha))
+        self.times.append(timestamp)
+
+    def tally(self, number_of_options=5, start=0, end=None):
+        """
+        Replay the votes between positions start and end, on top of the
+        baseline when start is 0.
+
+        Return a dict of choice to number of votes, like Poll.data.
+        """
+
+        counts = [0] * number_of_options
+
+        if start == 0:
+            for choice, count in enumerate(self.baseline):
+                _count(counts, choice, count)
+
+        for choice in self.choices[start:end]:
+            _count(counts, choice, 1)
+
+        return dict(enumerate(counts))
+
+    def set_baseline(self, data):
+        """
+        Set the baseline to the votes of data, a dict of choice to
+        number of votes like Poll.data, that are not in the log.
+        """
+
+        logged = []
+
+        for choice in self.choices:
+            _count(logged, choice, 1)
+
+        baseline = []
+
+        for choice in data.keys():
+            missing = int(data.get(choice, 0))
+
+            if choice < len(logged):
+                missing -= logged[choice]
+
+            if missing > 0:
+                _count(baseline, choice, missing)
+
+        self.baseline = array('I', baseline)
+
+    def window(self, since, until=None):
+        """
+        Return the (start, end) positions of the votes cast since
+        timestamp since and before timestamp until.
+        """
+
+        start = bisect_left(self.times, since)
+
+        if until is None:
+            return start, len(self.times)
+
+        return start, bisect_right(self.times, until, start)
+
+    def voters_count(self):
+        """
+        Return the number of different voters.
+        """
+
+        return len(self._voter_shas)
+
+    def dump(self):
+        """
+        Return the log as a dict of builtin types for the journal.
+        """
+
+        return {'voter_shas': list(self._voter_shas),
+                'choices': self.choices.tolist(),
+                'voters': self.voters.tolist(),
+                'times': self.times.tolist(),
+                'baseline': self.baseline.tolist()}
+
+    @classmethod
+    def load(cls, data):
+        """
+        Create a VoteLog from the output of dump().
+        """
+
+        log = cls()
+        log._voter_shas = [intern(str(votersha))
+                           for votersha in data['voter_shas']]
+
+        log.choices.fromlist([int(choice) for choice in data['choices']])
+        log.voters.fromlist([int(voter) for voter in data['voters']])
+        log.times.fromlist([float(stamp) for stamp in data['times']])
+        log.baseline.fromlist([int(count)
+                               for count in data.get('baseline', [])])
+
+        return log
+
+    def __intern_voter(self, votersha):
+
+        if self._voter_index is None:
+            self._voter_index = dict(
+                (sha, index) for index, sha in enumerate(self._voter_shas))
+
+        index = self._voter_index.get(votersha)
+
+        if index is None:
+            index = len(self._voter_shas)
+            self._voter_shas.append(intern(str(votersha)))
+            self._voter_index[votersha] = index
+
+        return index
+
+
+def _count(counts, choice, count):
+    """
+    Add count votes for choice to the list counts, growing it if needed.
+    """
+
+    if choice >= len(counts):
+        counts.extend([0] * (choice + 1 - len(counts)))
+
+    counts[choice] += count